@@ -1,23 +1,64 @@
+import os
+
 from .robot import Asserv, Action
+from . import trace
 
-NO_SMBUS = False
+# Run against the simulated picos of comm.sim, ex: HL_SIMULATE=1 python main.py b
+SIMULATE = os.environ.get("HL_SIMULATE", "0") == "1"
 
-# Check if we're running on the raspi
-try:
-	import smbus2
-except Exception:
-	print("Running without SMBUS")
-	NO_SMBUS = True
+# Record every I2C transaction, see comm.trace
+if os.environ.get("HL_I2C_TRACE", "0") == "1":
+	trace.enable()
 
 # Definition of Picos
 
 ASSERV_I2C_ADDR = 0x69
 ACTION_I2C_ADDR = 0x68
 
-I2C_BUS = None if NO_SMBUS else smbus2.SMBus(1)
+# BCM pins of the ready lines, None polls over I2C instead
+ASSERV_READY_PIN = None
+ACTION_READY_PIN = None
+
+def make_simulated_bus():
+	from . import sim
+	return sim.SimulatedBus({ASSERV_I2C_ADDR: sim.SimAsserv(), ACTION_I2C_ADDR: sim.SimAction()})
+
+# The bus is only opened by the first make_asserv/make_action or I2C_BUS access,
+# so scripts that just need the definitions (graph.py) never touch the hardware
+
+def open_bus():
+	global I2C_BUS, NO_SMBUS
+	if SIMULATE:
+		NO_SMBUS = False
+		I2C_BUS = make_simulated_bus()
+		return I2C_BUS
+
+	# Check if we're running on the raspi
+	try:
+		import smbus2
+	except Exception:
+		print("Running without SMBUS")
+		NO_SMBUS = True
+		I2C_BUS = None
+		return I2C_BUS
+
+	NO_SMBUS = False
+	I2C_BUS = smbus2.SMBus(1)
+	return I2C_BUS
+
+def __getattr__(name):
+	if name in ("I2C_BUS", "NO_SMBUS"):
+		open_bus()
+		return globals()[name]
+	raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_bus():
+	if "I2C_BUS" not in globals():
+		open_bus()
+	return I2C_BUS
 
 def make_asserv():
-	return Asserv(I2C_BUS, ASSERV_I2C_ADDR)
+	return Asserv(get_bus(), ASSERV_I2C_ADDR, ASSERV_READY_PIN)
 
 def make_action():
-	return Action(I2C_BUS, ACTION_I2C_ADDR)
+	return Action(get_bus(), ACTION_I2C_ADDR, ACTION_READY_PIN)
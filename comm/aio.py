@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import asyncio
+import time
+
+from .robot import abs_to_rel, POLLING_RATE, MIN_POLLING_RATE
+from .bus import Priority
+
+# Asyncio flavour of the picos, wraps a Asserv/Action and runs its smbus2 calls
+# on a dedicated executor so the event loop never blocks on the bus.
+# Commands (@block_cmd methods) are sent without blocking then awaited,
+# every other method just becomes a coroutine.
+
+class AsyncPicoBase:
+	def __init__(self, pico):
+		self.pico = pico
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"aio_pico_{pico.addr}")
+
+	def __getattr__(self, name):
+		attr = getattr(self.pico, name)
+		if not callable(attr):
+			return attr
+
+		if getattr(attr, "block_cmd", False):
+			async def cmd(*args, **kwargs):
+				if attr.stoppable:
+					await self.wait_running()
+				await self.run(attr, *args, blocking=False, **kwargs)
+				await self.wait_completed()
+			return cmd
+
+		async def call(*args, **kwargs):
+			return await self.run(attr, *args, **kwargs)
+		return call
+
+	async def run(self, func, *args, **kwargs):
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+	# Command Helpers
+
+	async def wait_running(self):
+		while not self.pico.running_flag.is_set():
+			await asyncio.sleep(1.0/POLLING_RATE)
+
+	# Like PicoBase.poll_completed, a stop ends the sleep early
+	async def sleep_or_wake(self, delay):
+		end = time.monotonic() + delay
+		while not self.pico.cmd_wake.is_set():
+			remaining = end - time.monotonic()
+			if remaining <= 0:
+				return
+			await asyncio.sleep(min(remaining, 1.0/POLLING_RATE))
+		self.pico.cmd_wake.clear()
+		self.pico.cmd_expected = 0
+
+	async def wait_completed(self):
+		pico = self.pico
+		if pico.i2c_simulate:
+			return
+
+		if pico.ready_line is None:
+			for delay in pico.poll_delays():
+				await self.sleep_or_wake(delay)
+				if await self.run(pico.ready_for_order):
+					break
+		else:
+			# Same as the threaded version, check the level if no edge came for a while
+			quiet_since = time.monotonic()
+			while not pico.cmd_done.is_set():
+				await asyncio.sleep(1.0/MIN_POLLING_RATE)
+				if time.monotonic() - quiet_since > 1.0/POLLING_RATE:
+					if pico.ready_line.state():
+						break
+					quiet_since = time.monotonic()
+		pico.cmd_done.set()
+
+class AsyncAsserv(AsyncPicoBase):
+	async def move(self, rho, theta):
+		pico = self.pico
+		while True:
+			await self.wait_running()
+			await self.run(pico.move, rho, theta, blocking=False)
+			await self.wait_completed()
+
+			if not pico.cmd_stopped:
+				return
+
+			# Emergency stop, restart with what was left once we can run again
+			await self.wait_running()
+			rho, theta = await self.run(pico.resume_segment)
+			print(f"Restart {rho:.2f} {theta:.2f}")
+
+	async def move_abs(self, tx, ty):
+		_, theta = await self.get_pos()
+		cx, cy = await self.get_pos_xy()
+		await self.move(*abs_to_rel(theta, cx, cy, tx, ty))
+
+	# Async telemetry, yields a snapshot of the asserv state at the given rate
+	async def snapshots(self, rate):
+		while True:
+			st = time.monotonic()
+			yield await self.run(self.pico.read_snapshot, Priority.TELEMETRY)
+			await asyncio.sleep(max(1/rate - (time.monotonic() - st), 0))
+
+class AsyncAction(AsyncPicoBase):
+	pass
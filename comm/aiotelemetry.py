@@ -0,0 +1,81 @@
+import asyncio
+
+from .telemetry import FrameReader
+
+# Asyncio flavour of telemetry.Client, kept apart so the robot scripts don't import asyncio
+
+# Reconnection delays, doubled after each failed attempt
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 10.0
+
+# Same wire format on asyncio, the loop receives straight into the FrameReader buffer
+class TelemetryProtocol(asyncio.BufferedProtocol):
+	def __init__(self, reader):
+		self.reader = reader
+		self.lost = asyncio.get_running_loop().create_future()
+
+	def get_buffer(self, sizehint):
+		return self.reader.recv_view()
+
+	def buffer_updated(self, nbytes):
+		self.reader.advance(nbytes)
+
+	def connection_lost(self, exc):
+		if not self.lost.done():
+			self.lost.set_result(exc)
+
+# One robot, reconnects with backoff until stopped. Many of them share one loop, ex:
+#	robots = [AsyncClient("main", ip, 1337, cb_main), AsyncClient("pami", ip_pami, 1337, cb_pami)]
+#	await asyncio.gather(*(robot.run() for robot in robots))
+class AsyncClient:
+	def __init__(self, name, addr, port, callback=None, batch_callback=None, frame_callback=None):
+		self.name = name
+		self.addr = addr
+		self.port = port
+		self.reader = FrameReader(callback, batch_callback=batch_callback, frame_callback=frame_callback)
+		self.transport = None
+		self.alive = True
+		self.connections = 0
+
+	@property
+	def connected(self):
+		return self.transport is not None
+
+	def stats(self):
+		return self.reader.stats()
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		delay = RECONNECT_MIN
+		while self.alive:
+			try:
+				self.reader.reset()
+				transport, protocol = await loop.create_connection(lambda: TelemetryProtocol(self.reader), self.addr, self.port)
+			except OSError as e:
+				print(f"{self.name}: {e}, retrying in {delay:.1f}s")
+				await asyncio.sleep(delay)
+				delay = min(delay*2, RECONNECT_MAX)
+				continue
+
+			self.transport = transport
+			self.connections += 1
+			since = loop.time()
+			try:
+				exc = await protocol.lost
+			finally:
+				self.transport = None
+				transport.close()
+			if not self.alive:
+				break
+
+			# Only a connection that held for a while resets the backoff
+			if loop.time() - since > RECONNECT_MAX:
+				delay = RECONNECT_MIN
+			print(f"{self.name}: connection lost ({exc}), reconnecting in {delay:.1f}s")
+			await asyncio.sleep(delay)
+			delay = min(delay*2, RECONNECT_MAX)
+
+	def stop(self):
+		self.alive = False
+		if self.transport is not None:
+			self.transport.close()
@@ -0,0 +1,108 @@
+from enum import IntEnum
+import threading
+import heapq
+import time
+
+from . import trace
+
+# Lower value gets the bus first
+
+class Priority(IntEnum):
+	ESTOP = 0
+	MOTION = 1
+	TELEMETRY = 2
+
+class LatencyStats:
+	def __init__(self):
+		self.count = 0
+		self.wait_total = 0
+		self.wait_max = 0
+		self.xfer_total = 0
+		self.xfer_max = 0
+
+	def add(self, wait, xfer):
+		self.count += 1
+		self.wait_total += wait
+		self.wait_max = max(self.wait_max, wait)
+		self.xfer_total += xfer
+		self.xfer_max = max(self.xfer_max, xfer)
+
+	def __str__(self):
+		if self.count == 0:
+			return "no transactions"
+		return (f"{self.count} txns, wait avg {self.wait_total/self.count*1e3:.2f}ms max {self.wait_max*1e3:.2f}ms, "
+				f"xfer avg {self.xfer_total/self.count*1e3:.2f}ms max {self.xfer_max*1e3:.2f}ms")
+
+class Transaction:
+	__slots__ = ("func", "args", "tag", "done", "result", "error", "queued")
+
+	def __init__(self, func, args, tag):
+		self.func = func
+		self.args = args
+		# (addr, reg, direction, size) for the tracer
+		self.tag = tag
+		self.done = threading.Event()
+		self.result = None
+		self.error = None
+		self.queued = time.perf_counter()
+
+# Owns a bus, transactions are queued by priority and run one by one on the bus thread
+# so an emergency stop never waits behind a queue of display reads
+
+class BusArbiter:
+	def __init__(self, bus):
+		self.bus = bus
+		self.queue = []
+		self.seq = 0
+		self.cond = threading.Condition()
+		self.latency = {prio: LatencyStats() for prio in Priority}
+
+		self.thread = threading.Thread(target=self.thread_func, daemon=True)
+		self.thread.start()
+
+	# Runs func(*args) on the bus thread and returns its result
+	def submit(self, prio, func, *args, tag=None):
+		txn = Transaction(func, args, tag)
+		with self.cond:
+			heapq.heappush(self.queue, (prio, self.seq, txn))
+			self.seq += 1
+			self.cond.notify()
+
+		txn.done.wait()
+		if txn.error is not None:
+			raise txn.error
+		return txn.result
+
+	def thread_func(self):
+		while True:
+			with self.cond:
+				while not self.queue:
+					self.cond.wait()
+				prio, _, txn = heapq.heappop(self.queue)
+
+			st = time.perf_counter()
+			try:
+				txn.result = txn.func(*txn.args)
+			except Exception as e:
+				txn.error = e
+			end = time.perf_counter()
+
+			self.latency[prio].add(st - txn.queued, end - st)
+			tracer = trace.TRACER
+			if tracer is not None and txn.tag is not None:
+				tracer.record(*txn.tag, st - txn.queued, end - st)
+			txn.done.set()
+
+	def stats(self):
+		return dict(self.latency)
+
+	def reset_stats(self):
+		for prio in Priority:
+			self.latency[prio] = LatencyStats()
+
+I2C_ARBITERS = {}
+
+def bus_arbiter(bus):
+	if bus not in I2C_ARBITERS:
+		I2C_ARBITERS[bus] = BusArbiter(bus)
+	return I2C_ARBITERS[bus]
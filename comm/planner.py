@@ -0,0 +1,302 @@
+from concurrent.futures import Future
+from dataclasses import dataclass
+import threading
+import math
+import time
+
+import numpy as np
+
+from .robot import abs_to_rel, Polyline, AsservSnapshot
+from .sim import ELEV_HOME_TIME, ELEV_SPEED, ARM_DEPLOY_TIME, ARM_TURN_SPEED
+
+# Offline timing of scenarios: a RecordingAsserv stands in for the Asserv while play() runs,
+# then the recorded segments are timed for any number of speed profiles at once, ex:
+#	rec = record(MyScenario(asserv, action, start_x, start_y, start_theta), (500, 1000), (3, 6))
+#	timing = rec.plan().evaluate(dst_vmax=np.linspace(300, 800, 500)[:,None])
+#	print(timing.total, timing.cutoff)
+# Scenarios come from handlers, which needs the raspi (RPi.GPIO) to be imported.
+# The action is replaced too, its commands take the time of the simulated actuators.
+# inst_wait and the sleeps of play() are recorded as waits instead of being slept.
+
+# Same as handlers.MATCH_PLAY_TIME, handlers needs the raspi to be imported
+MATCH_PLAY_TIME = 99
+
+# Vectorized trapezoid_time, see comm.robot
+def trapezoid_times(dst, vmax, amax):
+	dst, vmax, amax = np.broadcast_arrays(np.abs(dst), vmax, amax)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		trap = dst/vmax + vmax/amax
+		tri = 2*np.sqrt(dst/amax)
+		times = np.where(dst >= vmax*vmax/amax, trap, tri)
+	return np.where((dst == 0) | (vmax <= 0) | (amax <= 0), 0, times)
+
+@dataclass
+class PlanTiming:
+	# Every array is (..., segments), the leading dims being those of the profiles given to evaluate
+	times: np.ndarray
+	ends: np.ndarray
+	total: np.ndarray
+	# Index of the first segment not done before the end of the match, segments count if all are
+	cutoff: np.ndarray
+
+class Plan:
+	def __init__(self, rho, theta, dst_profile, angle_profile, waits):
+		self.rho = np.asarray(rho, dtype=np.float64)
+		self.theta = np.asarray(theta, dtype=np.float64)
+		# (segments, 2) vmax/amax in effect when each segment was sent
+		self.dst_profile = np.asarray(dst_profile, dtype=np.float64).reshape(-1, 2)
+		self.angle_profile = np.asarray(angle_profile, dtype=np.float64).reshape(-1, 2)
+		# Fixed time after each segment, actions, inst_wait and sleeps
+		self.waits = np.asarray(waits, dtype=np.float64)
+
+	def __len__(self):
+		return len(self.rho)
+
+	# Overrides broadcast against (segments,), give them a trailing axis to evaluate variants
+	def evaluate(self, dst_vmax=None, dst_amax=None, angle_vmax=None, angle_amax=None, waits=None, match_time=MATCH_PLAY_TIME):
+		pick = lambda val, default: default if val is None else np.asarray(val, dtype=np.float64)
+
+		# The pico turns first then goes straight, like Asserv.move_duration
+		times = trapezoid_times(self.theta, pick(angle_vmax, self.angle_profile[:,0]), pick(angle_amax, self.angle_profile[:,1]))
+		times = times + trapezoid_times(self.rho, pick(dst_vmax, self.dst_profile[:,0]), pick(dst_amax, self.dst_profile[:,1]))
+		times = times + pick(waits, self.waits)
+
+		ends = np.cumsum(times, axis=-1)
+		total = ends[...,-1] if len(self) else np.zeros(times.shape[:-1])
+		cutoff = (ends <= match_time).sum(axis=-1)
+		return PlanTiming(times, ends, total, cutoff)
+
+# Already done future, for calls made with future=True
+def completed(result=None):
+	fut = Future()
+	fut.set_result(result)
+	return fut
+
+# Drop-in for the Asserv, keeps track of the pose instead of moving
+class RecordingAsserv:
+	def __init__(self, x=0, y=0, theta=0, dst_profile=(0, 0), angle_profile=(0, 0)):
+		self.x = x
+		self.y = y
+		self.theta = theta
+		self.dst_profile = tuple(dst_profile)
+		self.angle_profile = tuple(angle_profile)
+		self.segments = []
+
+	# Scenario startup/finish and obstacle handling, nothing to drive
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	def set_running(self, state):
+		pass
+
+	def start_pose_refresh(self, rate=None):
+		pass
+
+	def stop_pose_refresh(self):
+		pass
+
+	def notify_stop(self):
+		pass
+
+	def notify_stop_clear(self):
+		pass
+
+	def register_names(self):
+		return {}
+
+	def set_dst_speedprofile(self, vmax, amax):
+		self.dst_profile = (vmax, amax)
+
+	def set_angle_speedprofile(self, vmax, amax):
+		self.angle_profile = (vmax, amax)
+
+	def get_dst_speedprofile(self):
+		return self.dst_profile
+
+	def get_angle_speedprofile(self):
+		return self.angle_profile
+
+	def move(self, rho, theta, future=False, **kwargs):
+		self.segments.append([rho, theta, self.dst_profile, self.angle_profile, 0])
+		self.theta += theta
+		self.x += rho*math.cos(self.theta)
+		self.y += rho*math.sin(self.theta)
+		if future:
+			return completed()
+
+	def move_abs(self, tx, ty, future=False, **kwargs):
+		self.move(*abs_to_rel(self.theta, self.x, self.y, tx, ty))
+		if future:
+			return completed()
+
+	# Queued segments are timed as if the pico stopped in between
+	def enqueue(self, segments, future=False, **kwargs):
+		for seg in segments:
+			self.move(seg.rho, seg.theta)
+		if future:
+			return completed()
+
+	# Timed as move_abs through each vertex, so an upper bound of the follower
+	def follow_path(self, points, future=False, **kwargs):
+		for tx, ty in Polyline(points).points:
+			if math.hypot(tx - self.x, ty - self.y) > 0:
+				self.move_abs(tx, ty)
+		if future:
+			return completed()
+
+	# Time spent on something else than moving, added after the last segment
+	def wait(self, duration):
+		if not self.segments:
+			self.move(0, 0)
+		self.segments[-1][4] += duration
+
+	def get_pos(self, max_age=None):
+		return 0, self.theta
+
+	def get_pos_xy(self, max_age=None):
+		return self.x, self.y
+
+	def get_snapshot(self, max_age=None, prio=None):
+		return AsservSnapshot(self.get_pos(), self.get_pos_xy(), 0, (0, 0, 0, 0), (0, 0, 0, 0))
+
+	def plan(self):
+		if not self.segments:
+			return Plan([], [], np.zeros((0, 2)), np.zeros((0, 2)), [])
+		rho, theta, dst_profile, angle_profile, waits = zip(*self.segments)
+		return Plan(rho, theta, dst_profile, angle_profile, waits)
+
+# Drop-in for the Action, each command adds the time the comm.sim actuators take to the plan.
+# Commands sent with blocking=False run alongside the next ones and add nothing
+class RecordingAction:
+	def __init__(self, rec):
+		self.rec = rec
+		self.homed = False
+		self.height = 0
+		# side -> [deploy angle, turn angle]
+		self.arms = {"right": [0, 0], "left": [0, 0]}
+
+	def command(self, duration, blocking=True, future=False):
+		if future or blocking:
+			self.rec.wait(duration)
+		if future:
+			return completed()
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	def set_running(self, state):
+		pass
+
+	def notify_stop(self):
+		pass
+
+	def notify_stop_clear(self):
+		pass
+
+	def register_names(self):
+		return {}
+
+	def elev_homed(self):
+		return self.homed
+
+	def elev_pos(self):
+		return self.height
+
+	def right_arm_deployed(self):
+		return self.arms["right"][0] == 90
+
+	def right_arm_angles(self):
+		return tuple(self.arms["right"])
+
+	def left_arm_deployed(self):
+		return self.arms["left"][0] == 90
+
+	def left_arm_angles(self):
+		return tuple(self.arms["left"])
+
+	def elev_home(self, **kwargs):
+		self.homed = True
+		self.height = 0
+		return self.command(ELEV_HOME_TIME, **kwargs)
+
+	def elev_move_abs(self, pos, **kwargs):
+		# The pico ignores it until homed
+		duration = abs(pos - self.height)/ELEV_SPEED if self.homed else 0
+		if self.homed:
+			self.height = pos
+		return self.command(duration, **kwargs)
+
+	def elev_move_rel(self, pos, **kwargs):
+		return self.elev_move_abs(self.height + pos, **kwargs)
+
+	def arm_deploy(self, side, angle, **kwargs):
+		arm = self.arms[side]
+		duration = ARM_DEPLOY_TIME*abs(angle - arm[0])/90
+		arm[0] = angle
+		return self.command(duration, **kwargs)
+
+	def arm_turn(self, side, angle, **kwargs):
+		self.arms[side][1] += angle
+		return self.command(abs(angle)/ARM_TURN_SPEED, **kwargs)
+
+	def right_arm_deploy(self, **kwargs):
+		return self.arm_deploy("right", 90, **kwargs)
+
+	def right_arm_half_deploy(self, **kwargs):
+		return self.arm_deploy("right", 45, **kwargs)
+
+	def right_arm_fold(self, **kwargs):
+		return self.arm_deploy("right", 0, **kwargs)
+
+	def right_arm_turn(self, angle, **kwargs):
+		return self.arm_turn("right", angle, **kwargs)
+
+	def left_arm_deploy(self, **kwargs):
+		return self.arm_deploy("left", 90, **kwargs)
+
+	def left_arm_half_deploy(self, **kwargs):
+		return self.arm_deploy("left", 45, **kwargs)
+
+	def left_arm_fold(self, **kwargs):
+		return self.arm_deploy("left", 0, **kwargs)
+
+	def left_arm_turn(self, angle, **kwargs):
+		return self.arm_turn("left", angle, **kwargs)
+
+	def pump_enable(self, pump_idx, state, **kwargs):
+		return self.command(0, **kwargs)
+
+# Runs the play() of a scenario on a RecordingAsserv (and a RecordingAction if it has an action),
+# skipping the startup wait. time.sleep from play(), so inst_wait and join too, becomes a wait.
+# The asserv poses are relative to the start like on the pico, returns the recording
+def record(scenario, dst_profile=(0, 0), angle_profile=(0, 0)):
+	rec = RecordingAsserv(0, 0, 0, dst_profile, angle_profile)
+	asserv, action = scenario.asserv, getattr(scenario, "action", None)
+	scenario.asserv = rec
+	if action is not None:
+		scenario.action = RecordingAction(rec)
+
+	# Only the thread running play() records, the scenario's other threads still sleep
+	player = threading.current_thread()
+	sleep = time.sleep
+	def record_sleep(duration):
+		if threading.current_thread() is player:
+			rec.wait(duration)
+		else:
+			sleep(duration)
+
+	time.sleep = record_sleep
+	try:
+		scenario.play()
+	finally:
+		time.sleep = sleep
+		scenario.asserv = asserv
+		if action is not None:
+			scenario.action = action
+	return rec
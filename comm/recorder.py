@@ -0,0 +1,167 @@
+import mmap
+import struct
+import time
+import os
+
+import numpy as np
+
+# Append-only telemetry log, ex:
+#	rec = Recorder("session.hlt")
+#	cl = telemetry.Client(ip, 1337, rec.record)
+#	...
+#	with Replay("session.hlt", comm.Asserv.telem_table()) as rep:
+#		pid = rep.query(1, t0, t1)
+#		plt.plot(pid["timestamp"], pid["input"])
+#
+# The file is a header followed by chunks, each holding records of a single telemetry idx:
+# chunk header (magic, idx, payload size, count, first and last receive time)
+# then count records of (receive time as a f8, raw payload).
+
+LOG_MAGIC = b"HLTL"
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct("<4sH")
+CHUNK_MAGIC = b"CHNK"
+CHUNK_HEADER = struct.Struct("<4sBBxxIdd")
+RECV_TIME = struct.Struct("<d")
+# Records kept in memory per idx before writing a chunk
+CHUNK_RECORDS = 4096
+
+class Recorder:
+	def __init__(self, path, chunk_records=CHUNK_RECORDS):
+		self.chunk_records = chunk_records
+		# idx -> [payload size, count, first time, last time, records]
+		self.pending = {}
+		new = not os.path.exists(path) or os.path.getsize(path) == 0
+		self.file = open(path, "ab")
+		if new:
+			self.file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION))
+		else:
+			with open(path, "rb") as f:
+				check_header(f.read(LOG_HEADER.size))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	# Telemetry callback, only frames that passed the CRC get here
+	def record(self, idx, data, recv_time=None):
+		if recv_time is None:
+			recv_time = time.time()
+
+		chunk = self.pending.get(idx)
+		if chunk is None or chunk[0] != len(data):
+			if chunk is not None:
+				self.write_chunk(idx)
+			chunk = self.pending[idx] = [len(data), 0, recv_time, recv_time, bytearray()]
+
+		chunk[1] += 1
+		chunk[3] = recv_time
+		chunk[4] += RECV_TIME.pack(recv_time)
+		chunk[4] += data
+		if chunk[1] >= self.chunk_records:
+			self.write_chunk(idx)
+
+	def write_chunk(self, idx):
+		size, count, first, last, records = self.pending.pop(idx)
+		self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, idx, size, count, first, last))
+		self.file.write(records)
+
+	def flush(self):
+		for idx in list(self.pending.keys()):
+			self.write_chunk(idx)
+		self.file.flush()
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+def check_header(header):
+	if len(header) < LOG_HEADER.size:
+		raise ValueError("Not a telemetry log")
+	magic, version = LOG_HEADER.unpack(header)
+	if magic != LOG_MAGIC:
+		raise ValueError("Not a telemetry log")
+	if version != LOG_VERSION:
+		raise ValueError(f"Unsupported telemetry log version {version}")
+
+class Chunk:
+	__slots__ = ("offset", "size", "count", "first", "last")
+
+	def __init__(self, offset, size, count, first, last):
+		self.offset = offset
+		self.size = size
+		self.count = count
+		self.first = first
+		self.last = last
+
+# Memory-maps a log, queries return views on the file when they fit in one chunk
+class Replay:
+	def __init__(self, path, telems=None):
+		# idx -> Telemetry, to decode payloads into their fields instead of raw bytes
+		self.telems = telems or {}
+		self.file = open(path, "rb")
+		check_header(self.file.read(LOG_HEADER.size))
+		size = os.path.getsize(path)
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+		self.chunks = {}
+		self.index(size)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	# Only reads the chunk headers, a chunk cut short by a crash ends the log
+	def index(self, size):
+		pos = LOG_HEADER.size
+		while pos + CHUNK_HEADER.size <= size:
+			magic, idx, psize, count, first, last = CHUNK_HEADER.unpack_from(self.map, pos)
+			if magic != CHUNK_MAGIC:
+				break
+			data = pos + CHUNK_HEADER.size
+			end = data + count*(RECV_TIME.size + psize)
+			if end > size:
+				break
+			self.chunks.setdefault(idx, []).append(Chunk(data, psize, count, first, last))
+			pos = end
+
+	def channels(self):
+		return sorted(self.chunks.keys())
+
+	def time_range(self, idx=None):
+		chunks = self.chunks[idx] if idx is not None else [c for cs in self.chunks.values() for c in cs]
+		return min(c.first for c in chunks), max(c.last for c in chunks)
+
+	def dtype(self, idx, size):
+		fields = [("recv_time", "<f8")]
+		telem = self.telems.get(idx)
+		if telem is not None and telem.size == size:
+			fields += telem.dtype().descr
+		else:
+			fields.append(("data", f"V{size}"))
+		return np.dtype(fields)
+
+	# Records of idx received between t0 and t1
+	def query(self, idx, t0=None, t1=None):
+		parts = []
+		for chunk in self.chunks.get(idx, []):
+			if (t0 is not None and chunk.last < t0) or (t1 is not None and chunk.first > t1):
+				continue
+			arr = np.frombuffer(self.map, self.dtype(idx, chunk.size), chunk.count, chunk.offset)
+			start = 0 if t0 is None else np.searchsorted(arr["recv_time"], t0, "left")
+			end = len(arr) if t1 is None else np.searchsorted(arr["recv_time"], t1, "right")
+			parts.append(arr[start:end])
+
+		if not parts:
+			return np.zeros(0, self.dtype(idx, self.telems[idx].size if idx in self.telems else 0))
+		if len(parts) == 1:
+			return parts[0]
+		return np.concatenate(parts)
+
+	def close(self):
+		# Views handed out keep the map alive
+		self.map = None
+		self.file.close()
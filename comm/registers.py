@@ -0,0 +1,100 @@
+from enum import Enum
+import struct
+
+ENDIANNESS = "<"
+
+class RegDir(Enum):
+	READ = 0
+	WRITE = 1
+
+# A pico register, declared once with its codec so the hot path doesn't rebuild formats
+
+class Register:
+	def __init__(self, name, reg, sub=0, fmt="", direction=RegDir.WRITE):
+		self.name = name
+		self.addr = reg | (sub << 4)
+		self.codec = struct.Struct(ENDIANNESS + fmt)
+		self.size = self.codec.size
+		self.direction = direction
+		# Reused by every write, only touch it from the bus thread
+		self.buf = bytearray(self.size)
+
+	def __repr__(self):
+		return f"Register({self.name}, 0x{self.addr:02x}, {self.codec.format}, {self.direction.name})"
+
+	def pack(self, *data):
+		self.codec.pack_into(self.buf, 0, *data)
+		return self.buf
+
+	def unpack(self, bys):
+		return self.codec.unpack(bys)
+
+def reg_table(name, reg, count, fmt="", direction=RegDir.WRITE):
+	return tuple(Register(f"{name}_{i}", reg, i, fmt, direction) for i in range(count))
+
+# Registers every pico has
+
+class PicoRegs:
+	RUNNING = Register("running", 0, 0, "B")
+	TELEM_DISABLE = Register("telem_disable", 6, 0, "B")
+	TELEM_ENABLE = Register("telem_enable", 6, 1, "B")
+	TELEM_DOWNSAMPLE = Register("telem_downsample", 6, 2, "BB")
+	# Bit idx enables telemetry idx, every telemetry in one write
+	TELEM_MASK = Register("telem_mask", 6, 3, "H")
+	READY = Register("ready", 10, 0, "?", RegDir.READ)
+
+class AsservRegs(PicoRegs):
+	ESTOP = Register("estop", 0, 1)
+	MOVE = Register("move", 1, 0, "ff")
+	# Indexed by pid idx
+	GET_PID = reg_table("get_pid", 2, 4, "fff", RegDir.READ)
+	# All of them in pid idx order
+	GET_PIDS = Register("get_pids", 2, 15, "fff"*4, RegDir.READ)
+	POS = Register("pos", 3, 0, "ff", RegDir.READ)
+	POS_XY = Register("pos_xy", 3, 1, "ff", RegDir.READ)
+	SNAPSHOT = Register("snapshot", 3, 2, "ffffB" + "ffff"*2, RegDir.READ)
+	# rho, theta left to reach the last commanded target
+	REMAINING = Register("remaining", 3, 3, "ff", RegDir.READ)
+	SET_PID = reg_table("set_pid", 5, 4, "fff")
+	SET_PIDS = Register("set_pids", 5, 15, "fff"*4)
+	# Command FIFO, segments are blended into each other
+	QUEUE_PUSH = Register("queue_push", 7, 0, "ff")
+	QUEUE_STATUS = Register("queue_status", 7, 1, "BBI", RegDir.READ) # depth, capacity, done
+	QUEUE_CLEAR = Register("queue_clear", 7, 2)
+	DEBUG_ENCODERS = Register("debug_encoders", 11, 0, "iiii", RegDir.READ)
+	DEBUG_MOTORS = Register("debug_motors", 11, 1, "ff")
+	DEBUG_TARGET = Register("debug_target", 11, 2, "ff")
+	DEBUG_MOTORS_ENABLE = Register("debug_motors_enable", 11, 3, "?")
+	DEBUG_CONTROLLER_STATE = Register("debug_controller_state", 11, 4, "B", RegDir.READ)
+	DEBUG_LEFT_BG_STATS = Register("debug_left_bg_stats", 11, 5, "ffff", RegDir.READ)
+	DEBUG_RIGHT_BG_STATS = Register("debug_right_bg_stats", 11, 6, "ffff", RegDir.READ)
+	DEBUG_EFFECTS = Register("debug_effects", 11, 7, "BBBBBff")
+	DEBUG_RGB = Register("debug_rgb", 11, 8, "IIB")
+	DEBUG_POPUP = Register("debug_popup", 11, 9, "ff")
+	DEBUG_LDRS = Register("debug_ldrs", 11, 10, "ff", RegDir.READ)
+	GET_DST_SPEEDPROFILE = Register("get_dst_speedprofile", 12, 0, "ff", RegDir.READ)
+	GET_ANGLE_SPEEDPROFILE = Register("get_angle_speedprofile", 12, 1, "ff", RegDir.READ)
+	SET_DST_SPEEDPROFILE = Register("set_dst_speedprofile", 13, 0, "ff")
+	SET_ANGLE_SPEEDPROFILE = Register("set_angle_speedprofile", 13, 1, "ff")
+	BATTERY_STATS = Register("battery_stats", 14, 0, "ffff", RegDir.READ)
+
+class ActionRegs(PicoRegs):
+	ELEV_HOME = Register("elev_home", 1, 0)
+	ELEV_MOVE_ABS = Register("elev_move_abs", 1, 1, "f")
+	ELEV_MOVE_REL = Register("elev_move_rel", 1, 2, "f")
+	ELEV_HOMED = Register("elev_homed", 1, 3, "?", RegDir.READ)
+	ELEV_POS = Register("elev_pos", 1, 4, "f", RegDir.READ)
+	RIGHT_ARM_DEPLOY = Register("right_arm_deploy", 2, 0)
+	RIGHT_ARM_FOLD = Register("right_arm_fold", 2, 1)
+	RIGHT_ARM_TURN = Register("right_arm_turn", 2, 2, "f")
+	RIGHT_ARM_DEPLOYED = Register("right_arm_deployed", 2, 3, "?", RegDir.READ)
+	RIGHT_ARM_ANGLES = Register("right_arm_angles", 2, 4, "ff", RegDir.READ)
+	RIGHT_ARM_HALF_DEPLOY = Register("right_arm_half_deploy", 2, 5)
+	LEFT_ARM_DEPLOY = Register("left_arm_deploy", 3, 0)
+	LEFT_ARM_FOLD = Register("left_arm_fold", 3, 1)
+	LEFT_ARM_TURN = Register("left_arm_turn", 3, 2, "f")
+	LEFT_ARM_DEPLOYED = Register("left_arm_deployed", 3, 3, "?", RegDir.READ)
+	LEFT_ARM_ANGLES = Register("left_arm_angles", 3, 4, "ff", RegDir.READ)
+	LEFT_ARM_HALF_DEPLOY = Register("left_arm_half_deploy", 3, 5)
+	# Indexed by pump idx
+	PUMP = reg_table("pump", 4, 16, "?")
@@ -0,0 +1,118 @@
+from collections import deque
+import threading
+import socket
+import sys
+
+from . import telemetry
+
+# Holds the only connection to the robot's telemetry server and republishes its valid frames,
+# in the same wire format, to any number of local clients, ex:
+#	python -m comm.relay 192.168.1.10
+#	python graph.py 127.0.0.1 --port 1338
+# Each subscriber has its own bounded queue, a slow one drops its oldest frames
+# instead of holding back the robot link or the other subscribers.
+
+TELEMETRY_PORT = 1337
+RELAY_PORT = 1338
+SUBSCRIBER_QUEUE = 4096
+
+class Subscriber:
+	def __init__(self, sock, addr, queue_size=SUBSCRIBER_QUEUE):
+		self.sock = sock
+		self.addr = addr
+		self.queue = deque()
+		self.queue_size = queue_size
+		self.cond = threading.Condition()
+		self.alive = True
+		self.sent = 0
+		self.dropped = 0
+
+		self.thread = threading.Thread(target=self.thread_func, daemon=True)
+		self.thread.start()
+
+	# From the upstream thread, never blocks on the subscriber's socket
+	def push(self, frame):
+		with self.cond:
+			if len(self.queue) >= self.queue_size:
+				self.queue.popleft()
+				self.dropped += 1
+			self.queue.append(frame)
+			self.cond.notify()
+
+	def stop(self):
+		with self.cond:
+			self.alive = False
+			self.cond.notify()
+		self.sock.close()
+
+	def thread_func(self):
+		while True:
+			with self.cond:
+				while self.alive and not self.queue:
+					self.cond.wait()
+				if not self.alive:
+					break
+				frames = list(self.queue)
+				self.queue.clear()
+
+			try:
+				self.sock.sendall(b"".join(frames))
+			except OSError:
+				break
+			self.sent += len(frames)
+		self.alive = False
+
+class Relay:
+	def __init__(self, addr, port=TELEMETRY_PORT, listen_port=RELAY_PORT, host="127.0.0.1", queue_size=SUBSCRIBER_QUEUE):
+		self.queue_size = queue_size
+		self.subscribers = []
+		self.lock = threading.Lock()
+		self.frames = 0
+
+		self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.server.bind((host, listen_port))
+		self.server.listen()
+		self.accept_thread = threading.Thread(target=self.accept_func, daemon=True)
+		self.accept_thread.start()
+
+		self.client = telemetry.Client(addr, port, frame_callback=self.handle_frame)
+
+	def accept_func(self):
+		while True:
+			try:
+				sock, addr = self.server.accept()
+			except OSError:
+				break
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			with self.lock:
+				self.subscribers.append(Subscriber(sock, addr, self.queue_size))
+
+	# The CRC was checked by the reader, the frame goes out as is
+	def handle_frame(self, idx, frame):
+		self.frames += 1
+		frame = bytes(frame)
+		with self.lock:
+			subs = self.subscribers = [sub for sub in self.subscribers if sub.alive]
+		for sub in subs:
+			sub.push(frame)
+
+	def stats(self):
+		with self.lock:
+			return {sub.addr: (sub.sent, sub.dropped) for sub in self.subscribers}
+
+	def stop(self):
+		self.server.close()
+		self.client.stop()
+		with self.lock:
+			for sub in self.subscribers:
+				sub.stop()
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("Give IP")
+		exit()
+
+	relay = Relay(sys.argv[1], listen_port=int(sys.argv[2]) if len(sys.argv) > 2 else RELAY_PORT)
+	print(f"Relaying {sys.argv[1]}:{TELEMETRY_PORT}")
+	relay.client.client_thread.join()
@@ -3,12 +3,61 @@ import struct
 import time
 import math
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from enum import Enum
 
 from . import telemetry
+from .registers import Register, PicoRegs, AsservRegs, ActionRegs
+from .bus import Priority, bus_arbiter
+from . import trace
+
+try:
+	from smbus2 import i2c_msg
+except Exception:
+	i2c_msg = None
+
+# Only available on the raspi, used for the pico ready lines
+try:
+	import RPi.GPIO as GPIO
+except Exception:
+	GPIO = None
 
 ENDIANNESS = "<"
 POLLING_RATE = 30
+# Readiness polling near the predicted end of a command
+MIN_POLLING_RATE = 200
+POLLING_BACKOFF = 1.2
+# Part of the predicted command time spent sleeping before polling
+PREDICT_SLEEP_RATIO = 0.9
+# Background pose cache refresh
+POSE_REFRESH_RATE = 50
+# Path follower, targets streamed at FOLLOW_RATE, FOLLOW_LOOKAHEAD mm ahead of the robot on the path
+FOLLOW_RATE = 50
+FOLLOW_LOOKAHEAD = 150
+# The follower only moves forward while the heading error is under this, slowing down as it grows
+FOLLOW_MAX_HEADING_ERROR = math.radians(45)
+# Lookahead past the end of the path, keeps the heading steady at the very end
+FOLLOW_END_LOOKAHEAD = 50
+# Stops within FOLLOW_TOLERANCE of the end along the last segment
+FOLLOW_TOLERANCE = 5
+# Gives up after FOLLOW_TIMEOUT_RATIO times the stop and turn time of the path, plus the margin
+FOLLOW_TIMEOUT_RATIO = 2
+FOLLOW_TIMEOUT_MARGIN = 2.0
+# Max payload of a SMBus block transfer, bigger reads use a raw combined transfer
+I2C_BLOCK_MAX = 32
+
+PID_STRUCT = struct.Struct(ENDIANNESS + "fff")
+
+# Struct codecs for the adhoc formats of write_struct/read_struct
+STRUCT_CACHE = {}
+
+def struct_codec(fmt):
+	codec = STRUCT_CACHE.get(fmt)
+	if codec is None:
+		codec = struct.Struct(ENDIANNESS + fmt)
+		STRUCT_CACHE[fmt] = codec
+	return codec
 
 @dataclass
 class Pid:
@@ -25,53 +74,171 @@ class Pid:
 		return self
 
 	def from_bytes(self, bys):
-		kp, ki, kd = struct.unpack(ENDIANNESS + "fff", bys)
+		kp, ki, kd = PID_STRUCT.unpack(bys)
 		self.set(kp, ki, kd)
 		return self
 
 	def to_bytes(self):
-		return struct.pack(ENDIANNESS + "fff", self.kp, self.ki, self.kd)
+		return PID_STRUCT.pack(self.kp, self.ki, self.kd)
+
+# Time to cover dst with a trapezoidal speed profile (triangular if vmax isn't reached)
+def trapezoid_time(dst, vmax, amax):
+	dst = abs(dst)
+	if dst == 0 or vmax <= 0 or amax <= 0:
+		return 0
+	if dst >= vmax*vmax/amax:
+		return dst/vmax + vmax/amax
+	return 2*math.sqrt(dst/amax)
+
+# Rotation then distance to go from the current pose to tx, ty
+def abs_to_rel(theta, cx, cy, tx, ty):
+	dx = tx - cx
+	dy = ty - cy
+
+	deltaTheta = (math.atan2(dy, dx)-theta)
+	deltaDst = math.sqrt(dx * dx + dy * dy)
+
+	sign = 1 if deltaTheta > 0 else -1
+
+	deltaTheta %= sign*2*math.pi
+
+	if abs(deltaTheta) > math.pi:
+		deltaTheta = deltaTheta - sign*2*math.pi
+
+	return deltaDst, deltaTheta
+
+# Part of the distance to cover while the heading is off, the rotation is much slower than the translation
+def heading_scale(deltaTheta):
+	return max(0, 1 - abs(deltaTheta)/FOLLOW_MAX_HEADING_ERROR)
+
+# Path as a list of (x, y) table points, ex: shortest_vectorized_path scaled to mm
+class Polyline:
+	def __init__(self, points):
+		self.points = [(float(x), float(y)) for x, y in points]
+		if not self.points:
+			raise ValueError("Path has no points")
+		# Distance along the path at each point
+		self.cum = [0]
+		for (x0, y0), (x1, y1) in zip(self.points, self.points[1:]):
+			self.cum.append(self.cum[-1] + math.hypot(x1 - x0, y1 - y0))
+		self.length = self.cum[-1]
+		# Only moves forward so the robot can't jump back to a part of the path it already did
+		self.idx = 0
+
+	# Distance along the path of the point closest to (x, y), searched from the current segment
+	# and stopping once the segments get further than lookahead past the closest one
+	def project(self, x, y, lookahead=FOLLOW_LOOKAHEAD):
+		best = None
+		for i in range(self.idx, len(self.points) - 1):
+			(x0, y0), (x1, y1) = self.points[i], self.points[i+1]
+			seg = self.cum[i+1] - self.cum[i]
+			t = 0 if seg == 0 else max(0, min(1, ((x - x0)*(x1 - x0) + (y - y0)*(y1 - y0))/(seg*seg)))
+			d = math.hypot(x0 + t*(x1 - x0) - x, y0 + t*(y1 - y0) - y)
+			if best is None or d < best[0]:
+				best = (d, i, self.cum[i] + t*seg)
+			elif d > best[0] + lookahead:
+				break
+		if best is None:
+			return self.length
+		self.idx = best[1]
+		return best[2]
+
+	# Direction of the last segment that isn't empty, None for a single point
+	def end_heading(self):
+		for (x0, y0), (x1, y1) in reversed(list(zip(self.points, self.points[1:]))):
+			if (x0, y0) != (x1, y1):
+				return math.atan2(y1 - y0, x1 - x0)
+		return None
 
-# Base class with I2C comm helpers
+	# Relative (rho, theta) of each leg when going through every point with stops, from the given pose
+	def legs(self, theta, x, y):
+		legs = []
+		for tx, ty in self.points:
+			if math.hypot(tx - x, ty - y) == 0:
+				continue
+			rho, dtheta = abs_to_rel(theta, x, y, tx, ty)
+			legs.append((rho, dtheta))
+			theta, x, y = theta + dtheta, tx, ty
+		return legs
+
+	def point_at(self, dst):
+		if dst >= self.length:
+			return self.points[-1]
+		i = self.idx
+		while self.cum[i+1] < dst:
+			i += 1
+		seg = self.cum[i+1] - self.cum[i]
+		t = 0 if seg == 0 else (dst - self.cum[i])/seg
+		(x0, y0), (x1, y1) = self.points[i], self.points[i+1]
+		return x0 + t*(x1 - x0), y0 + t*(y1 - y0)
 
-I2C_LOCKS = {}
+# Base class with I2C comm helpers
 
 class I2CBase:
 	def __init__(self, bus=None, addr=None):
 		self.bus = bus
 		self.addr = addr
 		self.i2c_simulate = bus is None
-		if bus in I2C_LOCKS:
-			self.lock = I2C_LOCKS[bus]
-		else:
-			self.lock = threading.Lock()
-			I2C_LOCKS[bus] = self.lock
+		self.arbiter = None if self.i2c_simulate else bus_arbiter(bus)
+
+	# Transfers, these run on the bus thread
+
+	def xfer_write(self, reg, data):
+		if len(data) > I2C_BLOCK_MAX:
+			# Without smbus2 this is the simulator, which takes any length
+			if i2c_msg is None:
+				self.bus.write_block(self.addr, reg, data)
+				return
+			self.bus.i2c_rdwr(i2c_msg.write(self.addr, bytes([reg]) + bytes(data)))
+			return
+		self.bus.write_i2c_block_data(self.addr, reg, data)
+
+	def xfer_read(self, reg, size):
+		if size <= I2C_BLOCK_MAX:
+			return bytes(self.bus.read_i2c_block_data(self.addr, reg, size))
+		if i2c_msg is None:
+			return bytes(self.bus.read_block(self.addr, reg, size))
 
-	def write(self, reg, data):
+		# Same thing on the wire: write the register then repeated start and read
+		wr, rd = i2c_msg.write(self.addr, [reg]), i2c_msg.read(self.addr, size)
+		self.bus.i2c_rdwr(wr, rd)
+		return bytes(rd)
+
+	def xfer_write_reg(self, register, data):
+		self.xfer_write(register.addr, register.pack(*data))
+
+	def write(self, reg, data, prio=Priority.MOTION):
 		if self.i2c_simulate:
 			return
 
-		with self.lock:
-			self.bus.write_i2c_block_data(self.addr, reg, data)
+		self.arbiter.submit(prio, self.xfer_write, reg, data, tag=trace.write_tag(self.addr, reg, len(data)))
 
-	def read(self, reg, size):
+	def read(self, reg, size, prio=Priority.MOTION):
 		if self.i2c_simulate:
 			return b"\x00"*size
 
-		with self.lock:
-			dat = bytes(self.bus.read_i2c_block_data(self.addr, reg, size))
+		return self.arbiter.submit(prio, self.xfer_read, reg, size, tag=trace.read_tag(self.addr, reg, size))
+
+	def write_cmd(self, reg, prio=Priority.MOTION):
+		self.write(reg, [], prio)
+
+	def write_struct(self, reg, fmt, *data, prio=Priority.MOTION):
+		self.write(reg, struct_codec(fmt).pack(*data), prio)
+
+	def read_struct(self, reg, fmt, prio=Priority.MOTION):
+		codec = struct_codec(fmt)
+		return codec.unpack(self.read(reg, codec.size, prio))
 
-		return dat
+	# Declared register helpers, packs into the register buffer on the bus thread
 
-	def write_cmd(self, reg):
-		self.write(reg, [])
+	def write_reg(self, register, *data, prio=Priority.MOTION):
+		if self.i2c_simulate:
+			return
 
-	def write_struct(self, reg, fmt, *data):
-		self.write(reg, struct.pack(ENDIANNESS + fmt, *data))
+		self.arbiter.submit(prio, self.xfer_write_reg, register, data, tag=trace.write_tag(self.addr, register.addr, register.size))
 
-	def read_struct(self, reg, fmt):
-		ret = self.read(reg, struct.calcsize(fmt))
-		return struct.unpack(ENDIANNESS + fmt, ret)
+	def read_reg(self, register, prio=Priority.MOTION):
+		return register.unpack(self.read(register.addr, register.size, prio))
 
 # A decorator to block until the command has finished
 def block_cmd(stoppable=False, move_func=False):
@@ -79,6 +246,12 @@ def block_cmd(stoppable=False, move_func=False):
 	def decorator(func):
 
 		def inner(self, *args, **kwargs):
+			# Run the whole blocking command on the pico's worker and hand back a future
+			# Commands on the same pico queue up in order, different picos run in parallel
+			if kwargs.pop("future", False):
+				kwargs["blocking"] = True
+				return self.cmd_executor().submit(inner, self, *args, **kwargs)
+
 			# Get default blocking behaviour
 			blocking = self.is_blocking()
 
@@ -87,60 +260,103 @@ def block_cmd(stoppable=False, move_func=False):
 				blocking = kwargs["blocking"]
 				del kwargs["blocking"]
 
-			# If this is a new stoppable command, wait until we're back running
-			if stoppable and not self.running_flag.is_set():
-				self.running_flag.wait()
-
+			# The target is recorded once, restarts only ask the pico what's left
 			if move_func:
-				cons_rho, cons_theta = args
-				old_rho, old_theta = self.get_pos()
+				self.track_segment(*args)
 
-			# Call the function normally
-			#print(f"func: {func} {args} {kwargs}")
-			#if move_func:
-			#	print(f"Move {cons_rho:.2f} {cons_theta:.2f}")
-			func(self, *args, **kwargs)
+			while True:
+				# Wait until we're back running, a new stop can also come in during a resume
+				if stoppable and not self.running_flag.is_set():
+					self.running_flag.wait()
 
-			# If we're simulating, don't block at all
-			if self.i2c_simulate:
-				return
+				# New command, completion is tracked from here
+				self.begin_cmd()
+
+				# Call the function normally
+				#print(f"func: {func} {args} {kwargs}")
+				func(self, *args, **kwargs)
+
+				# A stop that came in just before the order didn't stop it
+				if stoppable and not self.running_flag.is_set():
+					self.notify_stop_action()
 
-			# If we need to block, do so
-			if blocking:
-				self.wait_completed()
+				# If we're simulating, don't block at all
+				if self.i2c_simulate:
+					return
+
+				# If we need to block, do so
+				if blocking:
+					self.wait_completed()
+
+				# After an emergency stop, we've reached target so the blocking finishes
+				# We still want to block until we can start running again.
+				if not stoppable or not self.cmd_stopped:
+					return
 
-			# After an emergency stop, we've reached target so the blocking finishes
-			# We still want to block until we can start running again.
-			if stoppable and not self.running_flag.is_set():
 				self.running_flag.wait()
+				if not move_func:
+					return
 
-				if move_func:
-					new_rho, new_theta = self.get_pos()
-					diff_rho, diff_theta = new_rho-old_rho, new_theta-old_theta
-					new_cons_rho, new_cons_theta = cons_rho-diff_rho, cons_theta-diff_theta
-					if cons_theta == 0:
-						new_cons_theta = 0
-					if cons_rho == 0:
-						new_cons_rho = 0
-					print(f"Restart {new_cons_rho:.2f} {new_cons_theta:.2f} {kwargs}")
-					inner(self, new_cons_rho, new_cons_theta, blocking=blocking, **kwargs)
+				args = self.resume_segment()
+				print(f"Restart {args[0]:.2f} {args[1]:.2f} {kwargs}")
 
+		# Lets wrappers (comm.aio) know how to run it
+		inner.block_cmd = True
+		inner.stoppable = stoppable
 		return inner
 
 	return decorator
 
 
+# GPIO line the pico raises when it's ready for a new order
+
+class ReadyLine:
+	def __init__(self, pin, callback):
+		self.pin = pin
+		self.callback = callback
+
+		if GPIO.getmode() is None:
+			GPIO.setmode(GPIO.BCM)
+		GPIO.setup(pin, GPIO.IN, GPIO.PUD_DOWN)
+		GPIO.add_event_detect(pin, GPIO.RISING, callback=self.edge)
+
+	def state(self):
+		return GPIO.input(self.pin) == GPIO.HIGH
+
+	def edge(self, channel):
+		self.callback()
+
+	def close(self):
+		GPIO.remove_event_detect(self.pin)
+
 # Base class for pico microcontrollers on robots
 
 class PicoBase(I2CBase):
-	def __init__(self, bus=None, addr=None):
+	REGS = PicoRegs
+
+	def __init__(self, bus=None, addr=None, ready_pin=None):
 		super().__init__(bus, addr)
-		self.set_blocking(True)
-		self.set_running(False)
-		self.telems = {}
+		# Set when the last command sent has completed
+		self.cmd_done = threading.Event()
+		self.cmd_done.set()
+		self.cmd_start = 0
+		self.cmd_expected = 0
+		self.cmd_stopped = False
+		# Wakes up the readiness polling early
+		self.cmd_wake = threading.Event()
+		self.ready_line = None
+		self.executor = None
+		if ready_pin is not None and not self.i2c_simulate:
+			if GPIO is None:
+				print(f"No GPIO, polling for readiness of pico 0x{addr:02x}")
+			else:
+				self.ready_line = ReadyLine(ready_pin, self.cmd_done_edge)
 		# The running flag is set if we can execute stoppable commands
 		self.running_flag = threading.Event()
 		self.running_flag.set()
+		self.set_blocking(True)
+		self.set_running(False)
+		self.telems = {}
 
 	# Data helpers
 
@@ -155,6 +371,16 @@ class PicoBase(I2CBase):
 			return self.telems[idx]
 		return None
 
+	# (addr, reg) -> name of the declared registers, for the I2C tracer
+	def register_names(self):
+		names = {}
+		for attr in dir(self.REGS):
+			regs = getattr(self.REGS, attr)
+			for register in regs if isinstance(regs, tuple) else (regs,):
+				if isinstance(register, Register):
+					names[(self.addr, register.addr)] = register.name
+		return names
+
 	# Blocking state logic
 
 	def set_blocking(self, val):
@@ -169,6 +395,9 @@ class PicoBase(I2CBase):
 		if self.running_flag.is_set():
 			self.notify_stop_action()
 		self.running_flag.clear()
+		# Even if the stop is cleared before the command is seen as done, it has to be resumed
+		self.cmd_stopped = True
+		self.cmd_wake.set()
 
 	def notify_stop_clear(self):
 		self.running_flag.set()
@@ -182,7 +411,7 @@ class PicoBase(I2CBase):
 	@block_cmd()
 	def set_running(self, state):
 		state = not not state
-		self.write_struct(0, "B", state)
+		self.write_reg(PicoRegs.RUNNING, state)
 		self.running = state
 
 	def start(self):
@@ -192,21 +421,116 @@ class PicoBase(I2CBase):
 		self.set_running(False)
 
 	def set_telem(self, telem, state):
-		self.write_struct(6 | ((1 if state else 0) << 4), "B", telem.idx)
+		self.write_reg(PicoRegs.TELEM_ENABLE if state else PicoRegs.TELEM_DISABLE, telem.idx)
 
 	def set_telem_downsample(self, telem, downsample):
-		self.write_struct(6 | (2 << 4), "BB", telem.idx, downsample)
+		self.write_reg(PicoRegs.TELEM_DOWNSAMPLE, telem.idx, downsample)
+
+	# Enables the given telemetries and disables all the others in one write
+	def set_telem_mask(self, enabled):
+		mask = 0
+		for telem in enabled:
+			mask |= 1 << telem.idx
+		self.write_reg(PicoRegs.TELEM_MASK, mask)
 
 	# Read registers
 
 	def ready_for_order(self):
-		return self.read_struct(10, "?")[0] == 1
+		return self.read_reg(PicoRegs.READY)[0] == 1
 
 	# Command Helpers
 
+	def cmd_executor(self):
+		if self.executor is None:
+			self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pico_{self.addr}")
+		return self.executor
+
+	# Gives a fresh completion event for the command about to be sent
+	def begin_cmd(self):
+		self.cmd_done = threading.Event()
+		self.cmd_start = time.monotonic()
+		# Commands that know how long they take set this after being sent
+		self.cmd_expected = 0
+		# A stop that's still on has to be resumed, and has to wake the wait
+		self.cmd_stopped = not self.running_flag.is_set()
+		if not self.cmd_stopped:
+			self.cmd_wake.clear()
+		return self.cmd_done
+
+	# Called from the GPIO thread on a rising edge of the ready line
+	def cmd_done_edge(self):
+		self.cmd_done.set()
+
 	def wait_completed(self):
-		while not self.ready_for_order():
-			time.sleep(1.0/POLLING_RATE)
+		if self.ready_line is None:
+			self.poll_completed()
+		else:
+			# An edge can be missed, so when it's quiet check the line level
+			# The pico lowers it as soon as it gets the order, well before the timeout
+			while not self.cmd_done.wait(1.0/POLLING_RATE):
+				if self.ready_line.state():
+					break
+		self.cmd_done.set()
+
+	# Sleeps through most of the predicted command time, then polls faster the closer
+	# we get to the predicted end and backs off to POLLING_RATE once it's overdue
+	def poll_completed(self):
+		for delay in self.poll_delays():
+			# A stop makes the pico ready early, don't sleep through it
+			if self.cmd_wake.wait(delay):
+				self.cmd_wake.clear()
+				self.cmd_expected = 0
+			if self.ready_for_order():
+				break
+
+	# Delays between readiness checks, shared with the asyncio flavour
+	def poll_delays(self):
+		if self.cmd_expected > 0:
+			yield max(self.cmd_start + PREDICT_SLEEP_RATIO*self.cmd_expected - time.monotonic(), 0)
+
+		# Nothing to poll around without a prediction, same rate as the overdue ones
+		period = 1.0/MIN_POLLING_RATE if self.cmd_expected > 0 else 1.0/POLLING_RATE
+		while True:
+			remaining = self.cmd_start + self.cmd_expected - time.monotonic()
+			if remaining > 0:
+				yield max(remaining/2, 1.0/MIN_POLLING_RATE)
+			else:
+				yield period
+				period = min(period*POLLING_BACKOFF, 1.0/POLLING_RATE)
+
+# Move being executed by the asserv, kept to resume it after an emergency stop
+
+@dataclass
+class MotionSegment:
+	rho: float
+	theta: float
+
+	# Helpers for Asserv.enqueue, theta in rad
+
+	@staticmethod
+	def move(rho, theta=0):
+		return MotionSegment(rho, theta)
+
+	@staticmethod
+	def turn(theta):
+		return MotionSegment(0, theta)
+
+# State of the asserv pico read in a single transfer
+
+ASSERV_SNAPSHOT_STRUCT = AsservRegs.SNAPSHOT.codec
+
+@dataclass
+class AsservSnapshot:
+	pos: tuple # rho, theta
+	pos_xy: tuple # x, y
+	controller_state: int
+	left_bg_stats: tuple # vel, curr, temp, vbus
+	right_bg_stats: tuple # vel, curr, temp, vbus
+
+	@staticmethod
+	def from_bytes(bys):
+		vals = ASSERV_SNAPSHOT_STRUCT.unpack(bys)
+		return AsservSnapshot(vals[0:2], vals[2:4], vals[4], vals[5:9], vals[9:13])
 
 class BlinkerState(Enum):
 	OFF = 0
@@ -239,22 +563,42 @@ class RingState(Enum):
 # Class for the pico that handles moving
 
 class Asserv(PicoBase):
-	def __init__(self, bus=None, addr=None):
-		super().__init__(bus, addr)
+	REGS = AsservRegs
+	PID_NAMES = ("theta", "rho", "left_vel", "right_vel")
+
+	def __init__(self, bus=None, addr=None, ready_pin=None):
+		super().__init__(bus, addr, ready_pin)
 
 		self.last_pos = (0,0) # rho, theta
 		self.last_pos_xy = (0,0) # x, y
-		self.set_running(False)
-		self.pids = {}
-		for pid in [Pid("theta", 0), Pid("rho", 1), Pid("left_vel", 2), Pid("right_vel", 3)]:
-			self.get_pid(pid)
-			idx = pid.idx
-			self.pids[idx] = pid
-			self.telems[idx] = telemetry.Telemetry(f"pid_{pid.name}", idx, telemetry.PidTelemetryPacket)
-		self.telems[4] = telemetry.Telemetry("power", 4, telemetry.PowerTelemetryPacket)
-
-		for telem in self.telems.values():
-			self.set_telem(telem, False)
+		self.last_snapshot = None
+		# time.monotonic() of the last read of each
+		self.last_pos_time = 0
+		self.last_pos_xy_time = 0
+		self.last_snapshot_time = 0
+		self.pose_thread = None
+		self.pose_alive = False
+		self.segment = None
+		self.queue_pending = deque()
+		self.queue_inflight = deque()
+		self.queue_total = 0
+		self.queue_done = 0
+		# (vmax, amax), fetched on the first move to predict its duration
+		self.dst_profile = None
+		self.angle_profile = None
+		# Gains are only read when first needed, see get_pids
+		self.pids = {idx: Pid(name, idx) for idx, name in enumerate(Asserv.PID_NAMES)}
+		self.pids_loaded = False
+		self.telems = Asserv.telem_table()
+
+		self.set_telem_mask(())
+
+	# Telemetry definitions, available without a pico
+	@staticmethod
+	def telem_table():
+		telems = {idx: telemetry.Telemetry(f"pid_{name}", idx, telemetry.PidTelemetryPacket) for idx, name in enumerate(Asserv.PID_NAMES)}
+		telems[4] = telemetry.Telemetry("power", 4, telemetry.PowerTelemetryPacket)
+		return telems
 
 	# Data helpers
 
@@ -278,177 +622,409 @@ class Asserv(PicoBase):
 
 	@block_cmd(stoppable=True, move_func=True)
 	def move(self, rho, theta):
-		self.write_struct(1, "ff", rho, theta)
+		self.write_reg(AsservRegs.MOVE, rho, theta)
+		self.cmd_expected = self.move_duration(rho, theta)
+
+	# Motion segment tracking
+
+	def track_segment(self, rho, theta):
+		self.segment = MotionSegment(rho, theta)
+
+	# What's left of the segment, read from the pico after a stop
+	def resume_segment(self, segment=None):
+		segment = segment or self.segment
+		rho, theta = self.read_reg(AsservRegs.REMAINING)
+		# Don't add a rotation/distance to a move that didn't ask for one
+		if segment.rho == 0:
+			rho = 0
+		if segment.theta == 0:
+			theta = 0
+		segment.rho, segment.theta = rho, theta
+		return rho, theta
+
+	# Command queue, segments run back to back on the pico without stopping in between
+
+	# Returns (depth, capacity, done), done counts all the segments finished since boot
+	def queue_status(self):
+		return self.read_reg(AsservRegs.QUEUE_STATUS)
+
+	# Returns (done, total) for the segments of the current enqueue
+	def queue_progress(self):
+		return self.queue_total - len(self.queue_pending) - len(self.queue_inflight), self.queue_total
+
+	def enqueue(self, segments, blocking=None, future=False):
+		if blocking is None:
+			blocking = self.is_blocking()
 
-	def move_abs(self, tx, ty):
-		dst, theta = self.get_pos()
-		cx, cy = self.get_pos_xy()
-		dx = tx - cx
-		dy = ty - cy
+		self.queue_pending.extend(segments)
+		self.queue_total += len(segments)
 
-		deltaTheta = (math.atan2(dy, dx)-theta)
-		deltaDst = math.sqrt(dx * dx + dy * dy)
+		if future or not blocking:
+			return self.cmd_executor().submit(self.feed_queue)
+		self.feed_queue()
 
-		sign = 1 if deltaTheta > 0 else -1
+	# Keeps the pico queue full until everything is done, resumes after emergency stops
+	def feed_queue(self):
+		if self.i2c_simulate:
+			self.queue_pending.clear()
+			return
 
-		deltaTheta %= sign*2*math.pi
+		_, _, self.queue_done = self.queue_status()
+		self.begin_cmd()
+		delays = None
+		while True:
+			depth, capacity, done = self.queue_status()
+			for _ in range((done - self.queue_done) % (1 << 32)):
+				self.queue_inflight.popleft()
+			self.queue_done = done
+
+			if self.cmd_stopped:
+				# The pico drops its queue on a stop, send back what was left
+				self.running_flag.wait()
+				if self.queue_inflight:
+					self.resume_segment(self.queue_inflight[0])
+				self.queue_pending.extendleft(reversed(self.queue_inflight))
+				self.queue_inflight.clear()
+				self.write_reg(AsservRegs.QUEUE_CLEAR)
+				depth = 0
+				self.begin_cmd()
+				# Stopped again during the resume, nothing goes out until it clears
+				if self.cmd_stopped:
+					continue
+
+			pushed = False
+			while self.queue_pending and depth < capacity:
+				seg = self.queue_pending.popleft()
+				self.write_reg(AsservRegs.QUEUE_PUSH, seg.rho, seg.theta)
+				self.queue_inflight.append(seg)
+				depth += 1
+				pushed = True
+
+			# Same as block_cmd, a stop just before the push didn't stop what was pushed
+			if pushed and not self.running_flag.is_set():
+				self.notify_stop_action()
+
+			if depth == 0 and not self.queue_pending:
+				break
+
+			# Poll around the end of the first segment if we have more to send, the end of the queue otherwise
+			if pushed or delays is None:
+				self.cmd_start = time.monotonic()
+				if self.queue_pending:
+					self.cmd_expected = self.move_duration(self.queue_inflight[0].rho, self.queue_inflight[0].theta)
+				else:
+					self.cmd_expected = sum(self.move_duration(seg.rho, seg.theta) for seg in self.queue_inflight)
+				delays = self.poll_delays()
+
+			if self.cmd_wake.wait(next(delays)):
+				self.cmd_wake.clear()
+
+		self.queue_total = 0
+		self.cmd_done.set()
+
+	# Predicted duration of a move, the pico turns first then goes straight
+	def move_duration(self, rho, theta):
+		if self.dst_profile is None:
+			self.dst_profile = self.get_dst_speedprofile()
+		if self.angle_profile is None:
+			self.angle_profile = self.get_angle_speedprofile()
+		return trapezoid_time(theta, *self.angle_profile) + trapezoid_time(rho, *self.dst_profile)
+
+	def move_abs(self, tx, ty, **kwargs):
+		# The position has to be read once the previous commands are done
+		if kwargs.pop("future", False):
+			kwargs["blocking"] = True
+			return self.cmd_executor().submit(self.move_abs, tx, ty, **kwargs)
 
-		if abs(deltaTheta) > math.pi:
-			deltaTheta = deltaTheta - sign*2*math.pi
+		dst, theta = self.get_pos()
+		cx, cy = self.get_pos_xy()
+		deltaDst, deltaTheta = abs_to_rel(theta, cx, cy, tx, ty)
 
 		#print(f"Moving {deltaTheta}rads, {deltaDst}mm")
-		self.move(deltaDst, deltaTheta)
+		self.move(deltaDst, deltaTheta, **kwargs)
+
+	# Follows a path without stopping at its corners, by streaming a target ahead of the robot on it
+	def follow_path(self, points, lookahead=FOLLOW_LOOKAHEAD, rate=FOLLOW_RATE, blocking=None, future=False):
+		if blocking is None:
+			blocking = self.is_blocking()
+		# Built first so an empty path raises here and not in a future
+		path = Polyline(points)
+		# The control loop needs a thread, non-blocking calls run on the command executor
+		if future or not blocking:
+			return self.cmd_executor().submit(self.follow_path, path.points, lookahead, rate, blocking=True)
+
+		if self.i2c_simulate:
+			return
+
+		heading = path.end_heading()
+		if heading is None:
+			return self.move_abs(*path.points[-1])
+		ex, ey = path.points[-1]
+
+		self.running_flag.wait()
+		self.begin_cmd()
+		snap = self.read_snapshot(Priority.MOTION)
+		x, y = snap.pos_xy
+		expected = sum(self.move_duration(rho, theta) for rho, theta in path.legs(snap.pos[1], x, y))
+		deadline = time.monotonic() + FOLLOW_TIMEOUT_RATIO*expected + FOLLOW_TIMEOUT_MARGIN
+		while True:
+			st = time.monotonic()
+			if self.cmd_stopped:
+				# The pico holds its position, carry on from wherever we are once we can move
+				self.running_flag.wait()
+				deadline += time.monotonic() - st
+				self.begin_cmd()
+				continue
+			if st > deadline:
+				print(f"Path follower timed out {math.hypot(ex - x, ey - y):.0f}mm from the end")
+				break
+
+			snap = self.read_snapshot(Priority.MOTION)
+			dst, theta = snap.pos
+			x, y = snap.pos_xy
+			done = path.project(x, y, lookahead)
+
+			if done + lookahead < path.length:
+				tx, ty = path.point_at(done + lookahead)
+				deltaDst, deltaTheta = abs_to_rel(theta, x, y, tx, ty)
+				self.debug_set_target(dst + deltaDst*heading_scale(deltaTheta), theta + deltaTheta)
+			else:
+				# End of the path: head for the end, then for a point on the last segment's line
+				# just past it so the heading stays steady, and close the distance along that line
+				along = (ex - x)*math.cos(heading) + (ey - y)*math.sin(heading)
+				past = max(0, FOLLOW_END_LOOKAHEAD - along)
+				tx = ex + past*math.cos(heading)
+				ty = ey + past*math.sin(heading)
+				_, deltaTheta = abs_to_rel(theta, x, y, tx, ty)
+				# Backwards if we went too far
+				left = math.hypot(ex - x, ey - y) if past == 0 else along
+				self.debug_set_target(dst + left*heading_scale(deltaTheta), theta + deltaTheta)
+				if abs(along) < FOLLOW_TOLERANCE:
+					break
+
+			self.cmd_wake.wait(max(0, 1/rate - (time.monotonic() - st)))
+
+		self.wait_completed()
 
 	def emergency_stop(self):
-		self.write_cmd(0 | (1 << 4))
+		self.write_reg(AsservRegs.ESTOP, prio=Priority.ESTOP)
 
 	def set_pid(self, pid):
 		self.pids[pid.idx] = pid
-		self.write(5 | (pid.idx << 4), pid.to_bytes())
+		self.write_reg(AsservRegs.SET_PID[pid.idx], pid.kp, pid.ki, pid.kd)
+
+	# Writes every pid at once, the ones not given keep their cached values
+	def set_pids(self, pids=()):
+		if not self.pids_loaded:
+			self.get_pids()
+		for pid in pids:
+			self.pids[pid.idx] = pid
+		data = []
+		for idx in range(len(AsservRegs.SET_PID)):
+			pid = self.pids[idx]
+			data += (pid.kp, pid.ki, pid.kd)
+		self.write_reg(AsservRegs.SET_PIDS, *data)
 
 	def set_dst_speedprofile(self, vmax, amax):
-		return self.write_struct(13 | (0 << 4), "ff", vmax, amax)
+		self.dst_profile = (vmax, amax)
+		return self.write_reg(AsservRegs.SET_DST_SPEEDPROFILE, vmax, amax)
 
 	def set_angle_speedprofile(self, vmax, amax):
-		return self.write_struct(13 | (1 << 4), "ff", vmax, amax)
+		self.angle_profile = (vmax, amax)
+		return self.write_reg(AsservRegs.SET_ANGLE_SPEEDPROFILE, vmax, amax)
 
 	# Read registers
 
-	def get_pos(self):
-		self.last_pos = self.read_struct(3 | (0 << 4), "ff")
+	# With a max_age (in s), the cached value is returned if it's recent enough
+
+	def get_pos(self, max_age=None):
+		if max_age is None or time.monotonic() - self.last_pos_time > max_age:
+			self.last_pos = self.read_reg(AsservRegs.POS)
+			self.last_pos_time = time.monotonic()
 		return self.last_pos
 
-	def get_pos_xy(self):
-		self.last_pos_xy = self.read_struct(3 | (1 << 4), "ff")
+	def get_pos_xy(self, max_age=None):
+		if max_age is None or time.monotonic() - self.last_pos_xy_time > max_age:
+			self.last_pos_xy = self.read_reg(AsservRegs.POS_XY)
+			self.last_pos_xy_time = time.monotonic()
 		return self.last_pos_xy
 
+	# Position, xy, controller state and motor stats in one transfer
+	def read_snapshot(self, prio=Priority.TELEMETRY):
+		snap = AsservSnapshot.from_bytes(self.read(AsservRegs.SNAPSHOT.addr, AsservRegs.SNAPSHOT.size, prio))
+		now = time.monotonic()
+		self.last_pos = snap.pos
+		self.last_pos_xy = snap.pos_xy
+		self.last_snapshot = snap
+		self.last_pos_time = self.last_pos_xy_time = self.last_snapshot_time = now
+		return snap
+
+	def get_snapshot(self, max_age=None, prio=Priority.TELEMETRY):
+		if max_age is None or time.monotonic() - self.last_snapshot_time > max_age:
+			return self.read_snapshot(prio)
+		return self.last_snapshot
+
+	# Keeps the pose cache fresh from a background thread, one snapshot per refresh
+
+	def start_pose_refresh(self, rate=POSE_REFRESH_RATE):
+		if self.pose_thread is not None or self.i2c_simulate:
+			return
+		self.pose_alive = True
+		self.pose_thread = threading.Thread(target=self.pose_thread_func, args=(rate,), daemon=True)
+		self.pose_thread.start()
+
+	def stop_pose_refresh(self):
+		thread, self.pose_thread = self.pose_thread, None
+		if thread is None:
+			return
+		self.pose_alive = False
+		thread.join()
+
+	def pose_thread_func(self, rate):
+		while self.pose_alive:
+			st = time.monotonic()
+			try:
+				self.read_snapshot(Priority.MOTION)
+			except Exception as e:
+				print(f"Pose refresh Exception: {e}")
+			time.sleep(max(0, 1/rate - (time.monotonic() - st)))
+
 	def get_pid(self, pid):
-		ret = self.read(2 | (pid.idx << 4), 4*3)
-		return pid.from_bytes(ret)
+		return pid.set(*self.read_reg(AsservRegs.GET_PID[pid.idx], Priority.TELEMETRY))
+
+	# Refreshes every pid in one transfer
+	def get_pids(self):
+		data = self.read_reg(AsservRegs.GET_PIDS, Priority.TELEMETRY)
+		for idx, pid in self.pids.items():
+			pid.set(*data[3*idx:3*idx+3])
+		self.pids_loaded = True
+		return self.pids
 
 	def get_dst_speedprofile(self):
-		return self.read_struct(12 | (0 << 4), "ff")
+		return self.read_reg(AsservRegs.GET_DST_SPEEDPROFILE)
 
 	def get_angle_speedprofile(self):
-		return self.read_struct(12 | (1 << 4), "ff")
+		return self.read_reg(AsservRegs.GET_ANGLE_SPEEDPROFILE)
 
 	def get_battery_stats(self):
-		return self.read_struct(14 | (0 << 4), "ffff")
+		return self.read_reg(AsservRegs.BATTERY_STATS, Priority.TELEMETRY)
 
 	# Read/Write
 
 	# returns left,right ticks
 	def debug_get_encoders(self):
-		return self.read_struct(11 | (0 << 4), "iiii")
+		return self.read_reg(AsservRegs.DEBUG_ENCODERS, Priority.TELEMETRY)
 
 	# sets motor speed values manually
 	def debug_set_motors(self, left, right):
-		self.write_struct(11 | (1 << 4), "ff", left, right)
+		self.write_reg(AsservRegs.DEBUG_MOTORS, left, right)
 
 	def debug_set_target(self, dst, theta):
-		self.write_struct(11 | (2 << 4), "ff", dst, theta)
+		self.write_reg(AsservRegs.DEBUG_TARGET, dst, theta)
 
 	def debug_set_motors_enable(self, state):
 		state = not not state
-		self.write_struct(11 | (3 << 4), "?", state)
+		self.write_reg(AsservRegs.DEBUG_MOTORS_ENABLE, state)
 
 	def debug_get_controller_state(self):
-		return self.read_struct(11 | (4 << 4), "B")[0]
+		return self.read_reg(AsservRegs.DEBUG_CONTROLLER_STATE)[0]
 
 	def debug_get_left_bg_stats(self):
-		return self.read_struct(11 | (5 << 4), "ffff")
+		return self.read_reg(AsservRegs.DEBUG_LEFT_BG_STATS, Priority.TELEMETRY)
 
 	def debug_get_right_bg_stats(self):
-		return self.read_struct(11 | (6 << 4), "ffff")
+		return self.read_reg(AsservRegs.DEBUG_RIGHT_BG_STATS, Priority.TELEMETRY)
 
 	def debug_set_effects(self, control: ControlState, blinker: BlinkerState = BlinkerState.OFF, stop: bool = False, 
 		center_stop: bool = False, headlight: HeadlightState = HeadlightState.OFF, ring: RingState = RingState.OFF, disco: bool = False, rev: bool = False, smoke: bool = False,
 		pop_left: float = 0, pop_right: float = 0):
 
 		boules = bool(stop) | (bool(center_stop) << 1) | (bool(disco) << 2) | (bool(rev) << 3) | (bool(smoke) << 4)
-		self.write_struct(11 | (7 << 4), "BBBBBff", boules, control.value, blinker.value, headlight.value, ring.value, pop_left, pop_right)
+		self.write_reg(AsservRegs.DEBUG_EFFECTS, boules, control.value, blinker.value, headlight.value, ring.value, pop_left, pop_right)
 
 	def debug_set_rgb(self, rgb: int, brightness: int, idx: int = 0xFFFFFFFF):
-		self.write_struct(11 | (8 << 4), "IIB", rgb, idx, brightness)
+		self.write_reg(AsservRegs.DEBUG_RGB, rgb, idx, brightness)
 
 	def debug_set_popup(self, left: float, right: float):
-		self.write_struct(11 | (9 << 4), "ff", left, right)
+		self.write_reg(AsservRegs.DEBUG_POPUP, left, right)
 
 	def debug_get_ldrs(self):
-		return self.read_struct(11 | (10 << 4), "ff")
+		return self.read_reg(AsservRegs.DEBUG_LDRS, Priority.TELEMETRY)
 
 # Class for the pico that handles actuators
 
 class Action(PicoBase):
-	def __init__(self, bus=None, addr=None):
-		super().__init__(bus, addr)
+	REGS = ActionRegs
+
+	def __init__(self, bus=None, addr=None, ready_pin=None):
+		super().__init__(bus, addr, ready_pin)
 
 	# Read
 
 	def elev_homed(self):
-		return self.read_struct(1 | (3 << 4), "?")[0]
+		return self.read_reg(ActionRegs.ELEV_HOMED)[0]
 
 	def elev_pos(self):
-		return self.read_struct(1 | (4 << 4), "f")[0]
+		return self.read_reg(ActionRegs.ELEV_POS)[0]
 
 	def right_arm_deployed(self):
-		return self.read_struct(2 | (3 << 4), "?")[0]
+		return self.read_reg(ActionRegs.RIGHT_ARM_DEPLOYED)[0]
 
 	def right_arm_angles(self):
-		return self.read_struct(2 | (4 << 4), "ff")
+		return self.read_reg(ActionRegs.RIGHT_ARM_ANGLES)
 
 	def left_arm_deployed(self):
-		return self.read_struct(3 | (3 << 4), "?")[0]
+		return self.read_reg(ActionRegs.LEFT_ARM_DEPLOYED)[0]
 
 	def left_arm_angles(self):
-		return self.read_struct(3 | (4 << 4), "ff")
+		return self.read_reg(ActionRegs.LEFT_ARM_ANGLES)
 
 	# Write
 
 	@block_cmd()
 	def elev_home(self):
-		self.write_cmd(1 | (0 << 4))
+		self.write_reg(ActionRegs.ELEV_HOME)
 
 	@block_cmd()
 	def elev_move_abs(self, pos):
-		self.write_struct(1 | (1 << 4), "f", pos)
+		self.write_reg(ActionRegs.ELEV_MOVE_ABS, pos)
 
 	@block_cmd()
 	def elev_move_rel(self, pos):
-		self.write_struct(1 | (2 << 4), "f", pos)
+		self.write_reg(ActionRegs.ELEV_MOVE_REL, pos)
 
 	@block_cmd()
 	def right_arm_deploy(self):
-		self.write_cmd(2 | (0 << 4))
+		self.write_reg(ActionRegs.RIGHT_ARM_DEPLOY)
 
 	@block_cmd()
 	def right_arm_half_deploy(self):
-		self.write_cmd(2 | (5 << 4))
+		self.write_reg(ActionRegs.RIGHT_ARM_HALF_DEPLOY)
 
 	@block_cmd()
 	def right_arm_fold(self):
-		self.write_cmd(2 | (1 << 4))
+		self.write_reg(ActionRegs.RIGHT_ARM_FOLD)
 
 	@block_cmd()
 	def right_arm_turn(self, angle):
-		self.write_struct(2 | (2 << 4), "f", angle)
+		self.write_reg(ActionRegs.RIGHT_ARM_TURN, angle)
 
 	@block_cmd()
 	def left_arm_deploy(self):
-		self.write_cmd(3 | (0 << 4))
+		self.write_reg(ActionRegs.LEFT_ARM_DEPLOY)
 
 	@block_cmd()
 	def left_arm_half_deploy(self):
-		self.write_cmd(3 | (5 << 4))
+		self.write_reg(ActionRegs.LEFT_ARM_HALF_DEPLOY)
 
 	@block_cmd()
 	def left_arm_fold(self):
-		self.write_cmd(3 | (1 << 4))
+		self.write_reg(ActionRegs.LEFT_ARM_FOLD)
 
 	@block_cmd()
 	def left_arm_turn(self, angle):
-		self.write_struct(3 | (2 << 4), "f", angle)
+		self.write_reg(ActionRegs.LEFT_ARM_TURN, angle)
 
 	@block_cmd()
 	def pump_enable(self, pump_idx, state):
-		self.write_struct(4 | (pump_idx << 4), "?", state)
\ No newline at end of file
+		self.write_reg(ActionRegs.PUMP[pump_idx], state)
\ No newline at end of file
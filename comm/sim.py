@@ -0,0 +1,358 @@
+import ctypes
+import math
+import time
+
+from .registers import RegDir, AsservRegs, ActionRegs
+
+# Simulated picos behind a smbus2 like bus, to run scenarios off-robot with real timings.
+# Each device decodes the same register map as comm.robot and updates a
+# kinematic model lazily whenever it's accessed.
+
+I2C_M_RD = 0x0001
+# Bus speed used to emulate transfer times, None to disable
+I2C_BITRATE = 400000
+# Integration step of the models
+SIM_DT = 0.001
+
+# Robot geometry, close enough to the real one for bg stats and encoders
+WHEEL_RADIUS = 35 # mm
+WHEEL_TRACK = 250 # mm
+ENCODER_TICKS_PER_MM = 20
+
+class SimulatedBus:
+	def __init__(self, devices, bitrate=I2C_BITRATE):
+		self.devices = devices
+		self.bitrate = bitrate
+		self.reads = 0
+		self.writes = 0
+		self.bytes = 0
+
+	def device(self, addr):
+		if addr not in self.devices:
+			raise OSError(121, f"No device at 0x{addr:02x}")
+		return self.devices[addr]
+
+	# Address, register and ack bits plus data
+	def wait_xfer(self, size):
+		self.bytes += size
+		if self.bitrate is not None:
+			time.sleep((size+3)*9/self.bitrate)
+
+	def read_i2c_block_data(self, addr, reg, length):
+		self.reads += 1
+		self.wait_xfer(length)
+		return list(self.device(addr).read(reg, length))
+
+	def write_i2c_block_data(self, addr, reg, data):
+		self.writes += 1
+		self.wait_xfer(len(data))
+		self.device(addr).write(reg, bytes(data))
+
+	# Transfers of any length, what comm.robot uses for long ones when smbus2 isn't there
+	def read_block(self, addr, reg, length):
+		self.reads += 1
+		self.wait_xfer(length)
+		return self.device(addr).read(reg, length)
+
+	def write_block(self, addr, reg, data):
+		self.writes += 1
+		self.wait_xfer(len(data))
+		self.device(addr).write(reg, bytes(data))
+
+	# Only the register write + read pair comm.robot uses for long reads
+	def i2c_rdwr(self, *msgs):
+		reg = None
+		for msg in msgs:
+			if msg.flags & I2C_M_RD:
+				data = self.read_block(msg.addr, reg, msg.len)
+				ctypes.memmove(msg.buf, data, msg.len)
+			else:
+				self.device(msg.addr)
+				dat = bytes(msg)
+				reg = dat[0]
+				if len(dat) > 1:
+					self.write_block(msg.addr, reg, dat[1:])
+
+	def close(self):
+		pass
+
+# Axis following a target with a trapezoidal speed profile
+
+class SimAxis:
+	def __init__(self, vmax, amax):
+		self.vmax = vmax
+		self.amax = amax
+		self.pos = 0
+		self.vel = 0
+		self.target = 0
+
+	def reached(self):
+		return self.pos == self.target and self.vel == 0
+
+	def step(self, dt):
+		err = self.target - self.pos
+		if abs(err) < 1e-3 and abs(self.vel) <= self.amax*dt:
+			self.pos = self.target
+			self.vel = 0
+			return 0
+
+		# Fastest speed we can still brake from
+		vdes = math.copysign(min(self.vmax, math.sqrt(2*self.amax*abs(err))), err)
+		dv = max(-self.amax*dt, min(self.amax*dt, vdes - self.vel))
+		self.vel += dv
+		move = self.vel*dt
+		# Don't overshoot because of the step size
+		if abs(move) > abs(err):
+			move = err
+		self.pos += move
+		return move
+
+class SimPico:
+	def __init__(self, regs):
+		self.running = False
+		self.telems = {}
+		self.downsample = {}
+		self.last_update = time.monotonic()
+		self.readers = {}
+		self.writers = {}
+		self.on(regs.RUNNING, self.set_running)
+		self.on(regs.TELEM_DISABLE, lambda idx: self.telems.__setitem__(idx, False))
+		self.on(regs.TELEM_ENABLE, lambda idx: self.telems.__setitem__(idx, True))
+		self.on(regs.TELEM_DOWNSAMPLE, lambda idx, ds: self.downsample.__setitem__(idx, ds))
+		self.on(regs.TELEM_MASK, lambda mask: self.telems.update({idx: bool(mask >> idx & 1) for idx in range(16)}))
+		self.on(regs.READY, lambda: (self.ready(),))
+
+	# Registers a handler, readers return a tuple matching the register format
+	def on(self, register, handler):
+		if register.direction == RegDir.READ:
+			self.readers[register.addr] = (register, handler)
+		else:
+			self.writers[register.addr] = (register, handler)
+
+	def update(self):
+		now = time.monotonic()
+		while now - self.last_update >= SIM_DT:
+			self.step(SIM_DT)
+			self.last_update += SIM_DT
+
+	def read(self, reg, size):
+		self.update()
+		if reg not in self.readers:
+			return b"\x00"*size
+		register, handler = self.readers[reg]
+		return register.codec.pack(*handler())[:size]
+
+	def write(self, reg, data):
+		self.update()
+		if reg not in self.writers:
+			return
+		register, handler = self.writers[reg]
+		handler(*register.unpack(data[:register.size]))
+
+	def set_running(self, state):
+		self.running = bool(state)
+
+	# To be overriden by the models
+
+	def step(self, dt):
+		pass
+
+	def ready(self):
+		return True
+
+class SimAsserv(SimPico):
+	THETA = 0
+	DST = 1
+	REACHED = 2
+	QUEUE_CAPACITY = 8
+
+	def __init__(self):
+		super().__init__(AsservRegs)
+		self.rho = SimAxis(500, 1000)
+		self.theta = SimAxis(3, 6)
+		self.x = 0
+		self.y = 0
+		self.state = SimAsserv.REACHED
+		# Targets of the current move, theta is done first. Kept by emergency stops
+		self.move_theta = 0
+		self.move_rho = 0
+		self.pids = [(0, 0, 0)]*4
+		# Queued segments, the sim stops between them where the firmware blends them
+		self.queue = []
+		self.queue_busy = False
+		self.queue_done = 0
+		self.motors_enabled = False
+
+		self.on(AsservRegs.ESTOP, self.emergency_stop)
+		self.on(AsservRegs.MOVE, self.move)
+		self.on(AsservRegs.POS, lambda: (self.rho.pos, self.theta.pos))
+		self.on(AsservRegs.POS_XY, lambda: (self.x, self.y))
+		self.on(AsservRegs.SNAPSHOT, self.snapshot)
+		self.on(AsservRegs.QUEUE_PUSH, self.queue_push)
+		self.on(AsservRegs.QUEUE_STATUS, lambda: (len(self.queue) + self.queue_busy, SimAsserv.QUEUE_CAPACITY, self.queue_done))
+		self.on(AsservRegs.QUEUE_CLEAR, self.queue_clear)
+		self.on(AsservRegs.REMAINING, lambda: (self.move_rho - self.rho.pos, self.move_theta - self.theta.pos))
+		for idx in range(len(self.pids)):
+			self.on(AsservRegs.GET_PID[idx], lambda idx=idx: self.pids[idx])
+			self.on(AsservRegs.SET_PID[idx], lambda kp, ki, kd, idx=idx: self.pids.__setitem__(idx, (kp, ki, kd)))
+		self.on(AsservRegs.GET_PIDS, lambda: sum(self.pids, ()))
+		self.on(AsservRegs.SET_PIDS, lambda *vals: setattr(self, "pids", [vals[i:i+3] for i in range(0, len(vals), 3)]))
+		self.on(AsservRegs.DEBUG_ENCODERS, self.encoders)
+		self.on(AsservRegs.DEBUG_TARGET, self.set_target)
+		self.on(AsservRegs.DEBUG_MOTORS_ENABLE, lambda state: setattr(self, "motors_enabled", state))
+		self.on(AsservRegs.DEBUG_CONTROLLER_STATE, lambda: (self.state,))
+		self.on(AsservRegs.DEBUG_LEFT_BG_STATS, lambda: self.bg_stats(-1))
+		self.on(AsservRegs.DEBUG_RIGHT_BG_STATS, lambda: self.bg_stats(1))
+		self.on(AsservRegs.DEBUG_LDRS, lambda: (300, 300))
+		self.on(AsservRegs.GET_DST_SPEEDPROFILE, lambda: (self.rho.vmax, self.rho.amax))
+		self.on(AsservRegs.GET_ANGLE_SPEEDPROFILE, lambda: (self.theta.vmax, self.theta.amax))
+		self.on(AsservRegs.SET_DST_SPEEDPROFILE, lambda vmax, amax: self.set_profile(self.rho, vmax, amax))
+		self.on(AsservRegs.SET_ANGLE_SPEEDPROFILE, lambda vmax, amax: self.set_profile(self.theta, vmax, amax))
+		self.on(AsservRegs.BATTERY_STATS, lambda: (12.6, 1.5, 18.9, 95))
+
+	def step(self, dt):
+		if not self.running:
+			return
+
+		self.theta.step(dt)
+		drho = self.rho.step(dt)
+		self.x += drho*math.cos(self.theta.pos)
+		self.y += drho*math.sin(self.theta.pos)
+
+		if self.state == SimAsserv.THETA and self.theta.reached():
+			self.state = SimAsserv.DST
+			self.rho.target = self.move_rho
+		elif self.state == SimAsserv.DST and self.rho.reached():
+			self.state = SimAsserv.REACHED
+			if self.queue_busy:
+				self.queue_busy = False
+				self.queue_done = (self.queue_done + 1) % (1 << 32)
+
+		if self.state == SimAsserv.REACHED and self.queue:
+			self.move(*self.queue.pop(0))
+			self.queue_busy = True
+
+	def ready(self):
+		return not self.running or (self.state == SimAsserv.REACHED and not self.queue)
+
+	def set_running(self, state):
+		super().set_running(state)
+		if not self.running:
+			self.emergency_stop()
+
+	def set_profile(self, axis, vmax, amax):
+		axis.vmax = vmax
+		axis.amax = amax
+
+	def move(self, rho, theta):
+		if not self.running:
+			return
+		self.move_theta = self.theta.target + theta
+		self.move_rho = self.rho.target + rho
+		self.theta.target = self.move_theta
+		self.state = SimAsserv.THETA
+
+	def queue_push(self, rho, theta):
+		if self.running and len(self.queue) + self.queue_busy < SimAsserv.QUEUE_CAPACITY:
+			self.queue.append((rho, theta))
+
+	def queue_clear(self):
+		self.queue.clear()
+		self.queue_busy = False
+
+	# Stops right where we are, as if the target was reached, drops the queue
+	def emergency_stop(self):
+		self.queue_clear()
+		self.rho.target = self.rho.pos
+		self.theta.target = self.theta.pos
+		self.rho.vel = self.theta.vel = 0
+		self.state = SimAsserv.REACHED
+
+	# Both axes at once, like the firmware does for manual control
+	def set_target(self, dst, theta):
+		self.rho.target = dst
+		self.theta.target = theta
+		self.move_rho = dst
+		self.move_theta = theta
+		self.state = SimAsserv.DST
+
+	# side is -1 for left, 1 for right
+	def wheel_vel(self, side):
+		return (self.rho.vel - side*self.theta.vel*WHEEL_TRACK/2)/WHEEL_RADIUS
+
+	def bg_stats(self, side):
+		vel = self.wheel_vel(side)
+		return (vel, 0.2 + 0.05*abs(vel), 30, 12.6)
+
+	def encoders(self):
+		left = self.rho.pos + self.theta.pos*WHEEL_TRACK/2
+		right = self.rho.pos - self.theta.pos*WHEEL_TRACK/2
+		return (int(left*ENCODER_TICKS_PER_MM), int(right*ENCODER_TICKS_PER_MM),
+				int(self.wheel_vel(-1)*WHEEL_RADIUS*ENCODER_TICKS_PER_MM), int(self.wheel_vel(1)*WHEEL_RADIUS*ENCODER_TICKS_PER_MM))
+
+	def snapshot(self):
+		return (self.rho.pos, self.theta.pos, self.x, self.y, self.state) + self.bg_stats(-1) + self.bg_stats(1)
+
+# Timings of the actuators
+ELEV_HOME_TIME = 1.5 # s
+ELEV_SPEED = 100 # mm/s
+ARM_DEPLOY_TIME = 0.6 # s
+ARM_TURN_SPEED = 360 # deg/s
+
+class SimArm:
+	def __init__(self):
+		self.deployed = False
+		self.deploy_angle = 0
+		self.turn_angle = 0
+
+class SimAction(SimPico):
+	def __init__(self):
+		super().__init__(ActionRegs)
+		self.busy_until = 0
+		self.elev_homed = False
+		self.elev_pos = 0
+		self.pumps = {}
+		self.arms = {"right": SimArm(), "left": SimArm()}
+
+		self.on(ActionRegs.ELEV_HOME, self.elev_home)
+		self.on(ActionRegs.ELEV_MOVE_ABS, self.elev_move_abs)
+		self.on(ActionRegs.ELEV_MOVE_REL, lambda pos: self.elev_move_abs(self.elev_pos + pos))
+		self.on(ActionRegs.ELEV_HOMED, lambda: (self.elev_homed,))
+		self.on(ActionRegs.ELEV_POS, lambda: (self.elev_pos,))
+		for side in self.arms.keys():
+			prefix = side.upper() + "_ARM_"
+			arm = self.arms[side]
+			self.on(getattr(ActionRegs, prefix + "DEPLOY"), lambda arm=arm: self.arm_deploy(arm, 90))
+			self.on(getattr(ActionRegs, prefix + "HALF_DEPLOY"), lambda arm=arm: self.arm_deploy(arm, 45))
+			self.on(getattr(ActionRegs, prefix + "FOLD"), lambda arm=arm: self.arm_deploy(arm, 0))
+			self.on(getattr(ActionRegs, prefix + "TURN"), lambda angle, arm=arm: self.arm_turn(arm, angle))
+			self.on(getattr(ActionRegs, prefix + "DEPLOYED"), lambda arm=arm: (arm.deployed,))
+			self.on(getattr(ActionRegs, prefix + "ANGLES"), lambda arm=arm: (arm.deploy_angle, arm.turn_angle))
+		for idx, register in enumerate(ActionRegs.PUMP):
+			self.on(register, lambda state, idx=idx: self.pumps.__setitem__(idx, state))
+
+	def ready(self):
+		return time.monotonic() >= self.busy_until
+
+	def busy(self, duration):
+		self.busy_until = max(self.busy_until, time.monotonic()) + duration
+
+	def elev_home(self):
+		self.busy(ELEV_HOME_TIME)
+		self.elev_homed = True
+		self.elev_pos = 0
+
+	def elev_move_abs(self, pos):
+		if not self.elev_homed:
+			return
+		self.busy(abs(pos - self.elev_pos)/ELEV_SPEED)
+		self.elev_pos = pos
+
+	def arm_deploy(self, arm, angle):
+		self.busy(ARM_DEPLOY_TIME*abs(angle - arm.deploy_angle)/90)
+		arm.deploy_angle = angle
+		arm.deployed = angle == 90
+
+	def arm_turn(self, arm, angle):
+		self.busy(abs(angle)/ARM_TURN_SPEED)
+		arm.turn_angle += angle
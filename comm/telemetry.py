@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, make_dataclass, fields as dataclass_fields
 import threading
 import socket
 import struct
@@ -8,6 +8,10 @@ ENDIANNESS = "<"
 
 UPLINK_HEADER = b"\xDE\xAD"
 
+# Struct format chars to numpy types, for the batch decoding
+NUMPY_TYPES = {"b": "i1", "B": "u1", "?": "?", "h": "i2", "H": "u2", "i": "i4", "I": "u4",
+				"l": "i4", "L": "u4", "q": "i8", "Q": "u8", "e": "f2", "f": "f4", "d": "f8"}
+
 @dataclass
 class TelemetryPacketBase:
 	timestamp: float
@@ -43,6 +47,114 @@ class PowerTelemetryPacket(TelemetryPacketBase):
 
 TELEMETRY_TYPES = {0: PidTelemetryPacket, 1: PowerTelemetryPacket}
 
+# Struct format of a packet type, the fmt() of its bases followed by its own
+def packet_format(ty):
+	if "fmt" not in ty.__dict__:
+		return None
+	st = ""
+	for base in ty.__bases__:
+		if "fmt" not in base.__dict__:
+			continue
+		st += packet_format(base)
+	return st + ty.fmt()
+
+# Compiled layout of a packet type: codec, field offsets and numpy dtype, built once per type.
+# Versioned and serializable with describe() so a ground station can decode packet types
+# it has no class for, see SchemaRegistry.load
+class PacketSchema:
+	def __init__(self, name, fields, version=1, packet_type=None):
+		self.name = name
+		self.version = version
+		# ((field name, struct char), ...) in wire order, starting with the timestamp
+		self.fields = tuple((fname, ch) for fname, ch in fields)
+		if not self.fields or self.fields[0][0] != "timestamp":
+			raise ValueError(f"Packet {name} has to start with a timestamp")
+		self.names = tuple(fname for fname, _ in self.fields)
+		self.fmt = ENDIANNESS + "".join(ch for _, ch in self.fields)
+		self.codec = struct.Struct(self.fmt)
+		self.size = self.codec.size
+		self.offsets = {}
+		offset = 0
+		for fname, ch in self.fields:
+			self.offsets[fname] = offset
+			offset += struct.calcsize(ENDIANNESS + ch)
+		if packet_type is None:
+			packet_type = make_dataclass(name, [(fname, float if ch in "efd" else int) for fname, ch in self.fields[1:]], bases=(TelemetryPacketBase,))
+		self.packet_type = packet_type
+		self.np_dtype = None
+
+	def __repr__(self):
+		return f"PacketSchema({self.name} v{self.version}, {self.fmt})"
+
+	def decode(self, data):
+		return self.packet_type(*self.codec.unpack(data))
+
+	def encode(self, packet):
+		return self.codec.pack(*packet.__dict__.values())
+
+	def dtype(self):
+		if self.np_dtype is None:
+			# Only the ground station needs numpy, keep it out of the robot's imports
+			import numpy as np
+			self.np_dtype = np.dtype([(fname, ENDIANNESS + NUMPY_TYPES[ch]) for fname, ch in self.fields])
+		return self.np_dtype
+
+	def describe(self):
+		return {"name": self.name, "version": self.version, "fields": [list(field) for field in self.fields]}
+
+	@staticmethod
+	def from_description(desc):
+		return PacketSchema(desc["name"], desc["fields"], desc.get("version", 1))
+
+class SchemaRegistry:
+	def __init__(self):
+		# (name, version) -> schema, every version seen stays decodable
+		self.schemas = {}
+		# Newest version of each packet by name
+		self.latest = {}
+		self.compiled = {}
+
+	# Schema of a TelemetryPacketBase subclass, its version is the VERSION class attribute
+	def compile(self, packet_type):
+		schema = self.compiled.get(packet_type)
+		if schema is not None:
+			return schema
+
+		names = [field.name for field in dataclass_fields(packet_type)]
+		chars = packet_format(packet_type).lstrip("<>=!@")
+		if len(chars) != len(names):
+			raise ValueError(f"Format of {packet_type.__name__} doesn't have one char per field")
+		schema = self.register(PacketSchema(packet_type.__name__, zip(names, chars), getattr(packet_type, "VERSION", 1), packet_type))
+		self.compiled[packet_type] = schema
+		return schema
+
+	# Returns the schema kept for that name and version, a known one if the fields match
+	def register(self, schema):
+		key = (schema.name, schema.version)
+		current = self.schemas.get(key)
+		if current is None or current.fields != schema.fields:
+			self.schemas[key] = current = schema
+		if schema.version >= self.latest.get(schema.name, schema.version):
+			self.latest[schema.name] = schema.version
+		return current
+
+	# Newest version when none is given
+	def get(self, name, version=None):
+		if version is None:
+			version = self.latest.get(name)
+		return self.schemas.get((name, version))
+
+	def describe(self):
+		return [self.schemas[(name, version)].describe() for name, version in self.latest.items()]
+
+	# Schemas exactly as described, to decode what the other side sends
+	def load(self, descriptions):
+		return [self.register(PacketSchema.from_description(desc)) for desc in descriptions]
+
+SCHEMAS = SchemaRegistry()
+for packet_type in TELEMETRY_TYPES.values():
+	SCHEMAS.compile(packet_type)
+
 @dataclass
 class Telemetry:
 	name: str
@@ -51,40 +163,182 @@ class Telemetry:
 	fmt: str = ""
 	size: int = 0
 
+	# packet_base is a TelemetryPacketBase subclass or a PacketSchema
 	def __init__(self, name, idx, packet_base):
 		self.name = name
 		self.idx = idx
-		self.packet_type = packet_base
-		self.fmt = Telemetry.get_format(packet_base)
-		self.size = struct.calcsize(self.fmt)
+		self.schema = packet_base if isinstance(packet_base, PacketSchema) else SCHEMAS.compile(packet_base)
+		self.packet_type = self.schema.packet_type
+		self.fmt = self.schema.fmt
+		self.size = self.schema.size
 
+	@staticmethod
 	def get_format(ty):
-		if "fmt" not in ty.__dict__:
-			return None
-		st = ""
-		for base in ty.__bases__:
-			if "fmt" not in base.__dict__:
-				continue
-			st += Telemetry.get_format(base)
-		return st + ty.fmt()
+		return packet_format(ty)
 
 	def to_packet(self, data):
-		return self.packet_type(*struct.unpack(self.fmt,data))
+		return self.schema.decode(data)
 
 	def to_bytes(self, packet):
-		return struct.pack(self.fmt, *packet.__dict__.values())
+		return self.schema.encode(packet)
 
 	def fields(self):
-		vals = self.packet_type.__dict__["__match_args__"]
-		return tuple(filter(lambda x:x!="timestamp", vals))
+		return self.schema.names[1:]
+
+	# Structured dtype of a packet, one field per packet field
+	def dtype(self):
+		return self.schema.dtype()
+
+	# Decodes the payloads of consecutive packets at once, returns a structured array
+	def to_array(self, data):
+		import numpy as np
+		return np.frombuffer(data, self.dtype())
+
+	def describe(self):
+		return {"name": self.name, "idx": self.idx, "packet": self.schema.describe()}
+
+	@staticmethod
+	def from_description(desc, registry=SCHEMAS):
+		return Telemetry(desc["name"], desc["idx"], registry.load([desc["packet"]])[0])
+
+# Telemetry tables as JSON-able lists, to hand the definitions of a pico to a ground station
+def describe_telems(telems):
+	return [telem.describe() for telem in telems.values()]
+
+def telems_from_description(descriptions):
+	telems = {}
+	for desc in descriptions:
+		telem = Telemetry.from_description(desc)
+		telems[telem.idx] = telem
+	return telems
+
+# Frames are DE AD, size, idx, payload then the CRC32 of size, idx and payload
+FRAME_STRUCT = struct.Struct(ENDIANNESS + "BB")
+CRC_STRUCT = struct.Struct(ENDIANNESS + "I")
+FRAME_OVERHEAD = len(UPLINK_HEADER) + FRAME_STRUCT.size + CRC_STRUCT.size
+RECV_BUFFER_SIZE = 65536
+
+# Parses frames in place out of a preallocated buffer that the socket fills with recv_into,
+# the callback gets a memoryview of the payload that is only valid until it returns.
+# With a batch_callback, the payloads of each read are grouped by idx and handed over
+# once per idx as (idx, concatenated payloads), see Telemetry.to_array.
+# A frame_callback gets (idx, whole frame) to pass frames on without encoding them again
+class FrameReader:
+	def __init__(self, callback=None, size=RECV_BUFFER_SIZE, batch_callback=None, frame_callback=None):
+		self.callback = callback
+		self.batch_callback = batch_callback
+		self.frame_callback = frame_callback
+		self.batches = {}
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		# Unparsed data is buf[start:end]
+		self.start = 0
+		self.end = 0
+		self.reset_stats()
+
+	# To tell link errors (crc failures, bytes discarded) from reads cut in the middle of a frame
+	def reset_stats(self):
+		self.bytes_received = 0
+		self.frames = 0
+		self.crc_failures = 0
+		self.resyncs = 0
+		self.bytes_discarded = 0
+		self.short_reads = 0
+
+	def stats(self):
+		return {"bytes_received": self.bytes_received, "frames": self.frames, "crc_failures": self.crc_failures,
+				"resyncs": self.resyncs, "bytes_discarded": self.bytes_discarded, "short_reads": self.short_reads}
+
+	# Free space to receive into, moves the leftover partial frame to the front when needed
+	def recv_view(self):
+		if self.end == len(self.buf) or (self.start == self.end):
+			left = self.end - self.start
+			self.view[:left] = self.view[self.start:self.end]
+			self.start, self.end = 0, left
+		return self.view[self.end:]
+
+	# Drops a partial frame, for a new connection
+	def reset(self):
+		self.start = 0
+		self.end = 0
+
+	# Call after receiving n bytes into recv_view()
+	def advance(self, n):
+		self.end += n
+		self.bytes_received += n
+		self.parse()
+
+	# For data that didn't come from recv_into
+	def feed(self, data):
+		data = memoryview(data)
+		while len(data):
+			dst = self.recv_view()
+			n = min(len(dst), len(data))
+			dst[:n] = data[:n]
+			data = data[n:]
+			self.advance(n)
+
+	def parse(self):
+		buf, view = self.buf, self.view
+		pos, end = self.start, self.end
+		frames = 0
+		while end - pos >= FRAME_OVERHEAD:
+			if buf[pos] != UPLINK_HEADER[0] or buf[pos+1] != UPLINK_HEADER[1]:
+				self.resyncs += 1
+				nxt = buf.find(UPLINK_HEADER, pos+1, end)
+				if nxt < 0:
+					# Keep a trailing first header byte, its second one may be in the next read
+					nxt = end - 1 if buf[end-1] == UPLINK_HEADER[0] else end
+					self.bytes_discarded += nxt - pos
+					pos = nxt
+					break
+				self.bytes_discarded += nxt - pos
+				pos = nxt
+				continue
+
+			size, idx = FRAME_STRUCT.unpack_from(buf, pos+2)
+			if end - pos < size + FRAME_OVERHEAD:
+				break
+
+			# Straight over the buffer, size and idx are followed by the payload so it's one pass
+			data_end = pos + 4 + size
+			crc, = CRC_STRUCT.unpack_from(buf, data_end)
+			if crc != zlib.crc32(view[pos+2:data_end]):
+				# Not a real header, look for the next one
+				self.crc_failures += 1
+				self.bytes_discarded += 1
+				pos += 1
+				continue
+
+			frames += 1
+			if self.batch_callback is not None:
+				batch = self.batches.get(idx)
+				if batch is None:
+					batch = self.batches[idx] = bytearray()
+				batch += view[pos+4:data_end]
+			if self.callback is not None:
+				self.callback(idx, view[pos+4:data_end])
+			if self.frame_callback is not None:
+				self.frame_callback(idx, view[pos:data_end+CRC_STRUCT.size])
+			pos = data_end + CRC_STRUCT.size
+		self.start = pos
+		self.frames += frames
+		if pos != end:
+			self.short_reads += 1
+
+		for idx, batch in self.batches.items():
+			if batch:
+				self.batch_callback(idx, bytes(batch))
+				batch.clear()
 
 class Client:
-	def __init__(self, addr, port, callback):
+	def __init__(self, addr, port, callback=None, batch_callback=None, frame_callback=None):
 		self.alive = True
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.sock.connect((addr, port))
 
 		self.callback = callback
+		self.reader = FrameReader(callback, batch_callback=batch_callback, frame_callback=frame_callback)
 
 		self.client_thread = threading.Thread(target=self.client_handler, daemon=True)
 		self.client_thread.start()
@@ -94,59 +348,19 @@ class Client:
 		self.alive = False
 		self.client_thread.join()
 
+	def stats(self):
+		return self.reader.stats()
+
 	def client_handler(self):
 		while self.alive:
 			try:
-				dat = self.sock.recv(1)
-				if dat is None:
-					break
-				if struct.unpack(ENDIANNESS + "B",dat)[0] != UPLINK_HEADER[0]:
-					continue
-				#print(dat)
-
-				dat = self.sock.recv(1)
-				if dat is None:
-					break
-
-				if struct.unpack(ENDIANNESS + "B",dat)[0] != UPLINK_HEADER[1]:
-					continue
+				n = self.sock.recv_into(self.reader.recv_view())
 			except Exception as e:
 				print(e)
 				break
 
-			try:
-				size_dat = self.sock.recv(2)
-				if size_dat is None:
-					break
-			except:
+			if n == 0:
 				break
+			self.reader.advance(n)
 
-			if len(size_dat) < 2:
-				continue
-
-			size, idx = struct.unpack(ENDIANNESS + "BB", size_dat)
-
-			try:
-				pkt_data = self.sock.recv(size)
-				if pkt_data is None:
-					break
-			except:
-				break
-
-			try:
-				dat = self.sock.recv(4)
-				if dat is None:
-					break
-
-				crc, = struct.unpack(ENDIANNESS + "I", dat)
-				calc = zlib.crc32(size_dat+pkt_data)
-
-				if crc != calc:
-					#print("CRC mismatch")
-					continue
-			except Exception as e:
-				continue
-
-			self.callback(idx, pkt_data)
-
-		self.alive = False
\ No newline at end of file
+		self.alive = False
@@ -0,0 +1,114 @@
+import math
+import threading
+import time
+
+from .telemetry import FRAME_OVERHEAD
+
+# Chooses the downsampling of every telemetry of a pico to fit a bandwidth budget, ex:
+#	policy = TelemetryPolicy(asserv, 20000, {"pid_rho": HIGH, "power": LOW})
+#	policy.apply()
+#	cl = telemetry.Client(ip, 1337, policy.observe)
+# Channels share the budget according to their priority, a channel that needs less
+# than its share gives the rest to the others. Received frames are measured and
+# the factors recomputed when the rate drifts off the budget.
+
+OFF = 0
+LOW = 1
+NORMAL = 2
+HIGH = 4
+
+# Frames/s of a telemetry with no downsampling until it's been measured, the control loop rate
+DEFAULT_TELEM_RATE = 1000
+DOWNSAMPLE_MAX = 255
+# Measurement window, and how far from the budget the measured rate goes before rebalancing
+REBALANCE_PERIOD = 2.0
+REBALANCE_OVER = 1.1
+REBALANCE_UNDER = 0.5
+
+class TelemetryPolicy:
+	def __init__(self, pico, budget, priorities=None, default=NORMAL):
+		self.pico = pico
+		# Bytes/s for all of the pico's telemetry
+		self.budget = budget
+		self.priorities = {telem.idx: default for telem in pico.telems.values()}
+		for name, prio in (priorities or {}).items():
+			self.priorities[pico.telem_from_name(name).idx] = prio
+
+		self.base_rates = {idx: DEFAULT_TELEM_RATE for idx in self.priorities.keys()}
+		self.factors = {}
+		self.lock = threading.Lock()
+		self.counts = {}
+		self.window_start = time.monotonic()
+
+	def frame_size(self, idx):
+		return self.pico.telems[idx].size + FRAME_OVERHEAD
+
+	# Water-filling of the budget by priority, returns idx -> downsample, 0 for disabled
+	def compute(self):
+		full = {idx: self.base_rates[idx]*self.frame_size(idx) for idx, prio in self.priorities.items() if prio > OFF}
+		shares = {}
+		budget = self.budget
+		left = dict(full)
+		while left:
+			weight = sum(self.priorities[idx] for idx in left)
+			capped = {idx: bw for idx, bw in left.items() if bw <= budget*self.priorities[idx]/weight}
+			if not capped:
+				for idx in left:
+					shares[idx] = budget*self.priorities[idx]/weight
+				break
+			for idx, bw in capped.items():
+				shares[idx] = bw
+				budget -= bw
+				del left[idx]
+
+		factors = {idx: 0 for idx in self.priorities.keys()}
+		for idx, share in shares.items():
+			factors[idx] = DOWNSAMPLE_MAX if share <= 0 else max(1, min(DOWNSAMPLE_MAX, math.ceil(full[idx]/share)))
+		return factors
+
+	# Sends the factors that changed and the enable mask
+	def apply(self):
+		factors = self.compute()
+		for idx, factor in factors.items():
+			if factor > 0 and self.factors.get(idx) != factor:
+				self.pico.set_telem_downsample(self.pico.telems[idx], factor)
+		enabled = {idx for idx, factor in factors.items() if factor > 0}
+		if not self.factors or enabled != {idx for idx, factor in self.factors.items() if factor > 0}:
+			self.pico.set_telem_mask([self.pico.telems[idx] for idx in enabled])
+		self.factors = factors
+		return factors
+
+	# Telemetry client callback, counts what's received and rebalances once per period
+	def observe(self, idx, data):
+		with self.lock:
+			self.counts[idx] = self.counts.get(idx, 0) + 1
+			elapsed = time.monotonic() - self.window_start
+			if elapsed < REBALANCE_PERIOD:
+				return
+			counts, self.counts = self.counts, {}
+			self.window_start = time.monotonic()
+		self.rebalance(counts, elapsed)
+
+	def measured(self, counts, elapsed):
+		return sum(count*self.frame_size(idx) for idx, count in counts.items() if idx in self.priorities)/elapsed
+
+	def rebalance(self, counts, elapsed):
+		rate = self.measured(counts, elapsed)
+		if REBALANCE_UNDER*self.budget <= rate <= REBALANCE_OVER*self.budget:
+			return False
+
+		# What the pico produces before downsampling
+		for idx, count in counts.items():
+			if self.factors.get(idx, 0) > 0:
+				self.base_rates[idx] = count/elapsed*self.factors[idx]
+		old = self.factors
+		return self.apply() != old
+
+	def __str__(self):
+		lines = []
+		for idx, prio in self.priorities.items():
+			telem = self.pico.telems[idx]
+			factor = self.factors.get(idx)
+			state = "off" if factor == 0 else ("not applied" if factor is None else f"1/{factor}")
+			lines.append(f"{telem.name}: priority {prio}, base {self.base_rates[idx]:.0f}/s, {state}")
+		return "\n".join(lines)
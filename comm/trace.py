@@ -0,0 +1,75 @@
+import itertools
+import time
+
+from .registers import RegDir
+
+# Opt-in record of every I2C transaction, enabled with enable() or HL_I2C_TRACE=1
+
+TRACE_SIZE = 16384
+
+class I2CTracer:
+	def __init__(self, size=TRACE_SIZE):
+		self.size = size
+		self.clear()
+
+	def clear(self):
+		self.records = [None]*self.size
+		# next() on a count is atomic, so any thread can record without a lock
+		self.counter = itertools.count()
+		self.start = time.perf_counter()
+
+	# Called by the bus thread once a transaction is done
+	def record(self, addr, reg, direction, size, wait, xfer):
+		idx = next(self.counter)
+		self.records[idx % self.size] = (time.perf_counter(), addr, reg, direction, size, wait, xfer)
+
+	def snapshot(self):
+		return [rec for rec in self.records if rec is not None]
+
+	# names maps (pico addr, reg) to a register name, see PicoBase.register_names
+	def summary(self, names=None):
+		names = names or {}
+		recs = self.snapshot()
+		if not recs:
+			return "No I2C transactions traced"
+
+		span = max(rec[0] for rec in recs) - min(rec[0] - rec[6] for rec in recs)
+		busy = sum(rec[6] for rec in recs)
+		lines = [f"{len(recs)} transactions over {span:.2f}s, {len(recs)/span:.1f} txn/s, bus utilization {100*busy/span:.1f}%"]
+
+		per_reg = {}
+		for rec in recs:
+			per_reg.setdefault((rec[1], rec[2], rec[3]), []).append(rec)
+
+		lines.append("addr reg  dir count  bytes  wait p50/p99 (ms)  xfer p50/p99 (ms)  name")
+		for (addr, reg, direction), regs in sorted(per_reg.items(), key=lambda kv: -len(kv[1])):
+			waits = sorted(rec[5] for rec in regs)
+			xfers = sorted(rec[6] for rec in regs)
+			size = sum(rec[4] for rec in regs)
+			name = names.get((addr, reg), "")
+			lines.append(f"0x{addr:02x} 0x{reg:02x} {direction.name[0]}   {len(regs):<6} {size:<6} "
+						f"{percentile(waits, 50)*1e3:6.2f}/{percentile(waits, 99)*1e3:6.2f}    "
+						f"{percentile(xfers, 50)*1e3:6.2f}/{percentile(xfers, 99)*1e3:6.2f}    {name}")
+		return "\n".join(lines)
+
+def percentile(sorted_vals, pct):
+	idx = min(len(sorted_vals)-1, int(len(sorted_vals)*pct/100))
+	return sorted_vals[idx]
+
+TRACER = None
+
+def enable(size=TRACE_SIZE):
+	global TRACER
+	if TRACER is None:
+		TRACER = I2CTracer(size)
+	return TRACER
+
+def disable():
+	global TRACER
+	TRACER = None
+
+def read_tag(addr, reg, size):
+	return (addr, reg, RegDir.READ, size)
+
+def write_tag(addr, reg, size):
+	return (addr, reg, RegDir.WRITE, size)
@@ -1,10 +1,13 @@
 import math
+import json
 import time
 import argparse
 import cmd2
 
 import enum
 import comm
+import comm.telempolicy as telempolicy
+import comm.telemetry as telemetry
 try:
 	import handlers
 except Exception as e:
@@ -62,6 +65,8 @@ class BaseCommander(cmd2.Cmd):
 		super(BaseCommander, self).__init__(include_py=True)
 		self.pico = pico
 		self.started = False
+		self.telem_policy = None
+		self.telem_client = None
 
 	@cmd2.with_category("General")
 	def do_on(self, arg):
@@ -110,8 +115,7 @@ class BaseCommander(cmd2.Cmd):
 	def do_stelem(self, arg):
 		"""Turns on or off selected telemetry"""
 		if arg.telem == "all":
-			for telem in self.pico.telems.values():
-				self.pico.set_telem(telem, arg.enabled)
+			self.pico.set_telem_mask(self.pico.telems.values() if arg.enabled else ())
 			return
 
 		try:
@@ -151,6 +155,55 @@ class BaseCommander(cmd2.Cmd):
 
 		self.pico.set_telem_downsample(telem, arg.downsample)
 
+	tschema_parser = cmd2.Cmd2ArgumentParser()
+	tschema_parser.add_argument('path', type=str, nargs='?', help="File to write them to")
+
+	@cmd2.with_argparser(tschema_parser)
+	@cmd2.with_category("Telemetry")
+	def do_tschema(self, arg):
+		"""Dumps the telemetry definitions as json, for graph.py"""
+		desc = json.dumps(telemetry.describe_telems(self.pico.telems), indent="\t")
+		if arg.path is None:
+			self.poutput(desc)
+			return
+		with open(arg.path, "w") as f:
+			f.write(desc)
+
+	tbudget_parser = cmd2.Cmd2ArgumentParser()
+	tbudget_parser.add_argument('budget', type=float, help="Bytes/s for all the telemetry")
+	tbudget_parser.add_argument('priorities', type=str, nargs='*', help="name[:priority], 0 is off, default 2")
+	tbudget_parser.add_argument('-i', '--ip', type=str, help="Telemetry server to measure the rate from, rebalances when it drifts")
+	tbudget_parser.add_argument('-p', '--port', type=int, default=1337)
+
+	@cmd2.with_argparser(tbudget_parser)
+	@cmd2.with_category("Telemetry")
+	def do_tbudget(self, arg):
+		"""Sets every telemetry downsampling from a bandwidth budget"""
+		prios = {}
+		for item in arg.priorities:
+			name, _, prio = item.partition(":")
+			if not self.pico.telem_from_name(name):
+				self.poutput(f"Couldn't find the telemetry {name}")
+				return
+			try:
+				prios[name] = int(prio) if prio else telempolicy.NORMAL
+			except ValueError:
+				self.poutput(f"Invalid priority {prio} for {name}")
+				return
+
+		if self.telem_client is not None:
+			self.telem_client.stop()
+			self.telem_client = None
+
+		self.telem_policy = telempolicy.TelemetryPolicy(self.pico, arg.budget, prios)
+		self.telem_policy.apply()
+		self.poutput(self.telem_policy)
+		if arg.ip is not None:
+			try:
+				self.telem_client = telemetry.Client(arg.ip, arg.port, self.telem_policy.observe)
+			except OSError as e:
+				self.poutput(f"Couldn't connect to the telemetry: {e}")
+
 	@cmd2.with_category("Debug")
 	def do_ready(self, arg):
 		"""ready: checks if the robot is ready to receive a new order"""
@@ -160,6 +213,34 @@ class BaseCommander(cmd2.Cmd):
 		else:
 			self.poutput("Not Ready")
 
+	@cmd2.with_category("Debug")
+	def do_bus(self, arg):
+		"""Latency of the I2C transactions per priority"""
+		if self.pico.arbiter is None:
+			self.poutput("No I2C bus")
+			return
+
+		for prio, stats in self.pico.arbiter.stats().items():
+			self.poutput(f"{prio.name}: {stats}")
+
+	trace_parser = cmd2.Cmd2ArgumentParser()
+	trace_parser.add_argument('action', type=str, choices=["on", "off", "dump", "clear"], help="Start/stop recording, print the summary or clear it")
+
+	@cmd2.with_argparser(trace_parser)
+	@cmd2.with_category("Debug")
+	def do_trace(self, arg):
+		"""I2C transaction tracer"""
+		if arg.action == "on":
+			comm.trace.enable()
+		elif arg.action == "off":
+			comm.trace.disable()
+		elif comm.trace.TRACER is None:
+			self.poutput("Tracer is off")
+		elif arg.action == "dump":
+			self.poutput(comm.trace.TRACER.summary(self.pico.register_names()))
+		else:
+			comm.trace.TRACER.clear()
+
 	sb_parser = cmd2.Cmd2ArgumentParser()
 	sb_parser.add_argument('blocking', type=str2bool)
 
@@ -209,7 +290,7 @@ class AsservCommander(BaseCommander):
 	@cmd2.with_category("Asserv Tuning")
 	def do_pids(self, arg):
 		"""list all pids"""
-		for pid in self.pico.pids.values():
+		for pid in self.pico.get_pids().values():
 			self.poutput(pid)
 
 	def pid_choices(self):
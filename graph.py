@@ -1,11 +1,57 @@
-import sys
+import argparse
+import json
+import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 
 import comm.telemetry as telemetry
 import comm
 
-robot = comm.make_asserv()
+parser = argparse.ArgumentParser()
+parser.add_argument("ip")
+# Newer definitions than the local ones, see the commander's tschema
+parser.add_argument("telems", nargs="?", help="telemetry definitions json")
+# 1338 to go through comm.relay
+parser.add_argument("--port", type=int, default=1337)
+args = parser.parse_args()
+
+# Only the definitions, the pico is reached through the telemetry server
+if args.telems:
+	with open(args.telems) as f:
+		telems = telemetry.telems_from_description(json.load(f))
+else:
+	telems = comm.Asserv.telem_table()
+
+# Seconds shown, and samples kept per telemetry (a bit more than the window at a few kHz)
+PLOT_WINDOW = 10.0
+PLOT_CAPACITY = 1 << 16
+
+# Fixed size history, every sample is written twice so the last count samples
+# are always one contiguous slice and views never need a copy
+class RingBuffer:
+	def __init__(self, dtype, size):
+		self.size = size
+		self.data = np.zeros(2*size, dtype)
+		self.pos = 0
+		self.count = 0
+
+	def clear(self):
+		self.pos = 0
+		self.count = 0
+
+	def extend(self, arr):
+		arr = arr[-self.size:]
+		n = len(arr)
+		first = min(n, self.size - self.pos)
+		for off in (0, self.size):
+			self.data[off+self.pos:off+self.pos+first] = arr[:first]
+			self.data[off:off+n-first] = arr[first:]
+		self.pos = (self.pos + n) % self.size
+		self.count = min(self.size, self.count + n)
+
+	def view(self):
+		end = self.pos + self.size
+		return self.data[end-self.count:end]
 
 class TelemetryPlot:
 	def __init__(self, telem):
@@ -17,45 +63,43 @@ class TelemetryPlot:
 		self.ax.set_title(pretty_name)
 		self.ax.set_xlabel("Time (s)")
 		self.plots = {name:self.ax.plot([], [], label=name)[0] for name in telem.fields()}
-		self.time_data = []
-		self.plot_data = {name:[] for name in telem.fields()}
+		self.history = RingBuffer(telem.dtype(), PLOT_CAPACITY)
 		self.fig.legend()
 		self.anim = FuncAnimation(self.fig, self.update, interval=16, blit=True)
 
 	def update(self, i):
+		hist = self.history.view()
+		ts = hist["timestamp"]
+		# Only hand the visible part to matplotlib
+		start = np.searchsorted(ts, ts[-1]-PLOT_WINDOW) if len(ts) > 0 else 0
 		for name in self.plots.keys():
-			self.plots[name].set_data(self.time_data, self.plot_data[name])
+			self.plots[name].set_data(ts[start:], hist[name][start:])
 
-		if len(self.time_data) > 0:
-			mval = self.time_data[-1]
-			self.ax.set_xlim(mval-10.0, mval)
+		if len(ts) > 0:
+			mval = ts[-1]
+			self.ax.set_xlim(mval-PLOT_WINDOW, mval)
 
 		return self.plots.values()
 
-	def handle_data(self, dat):
-		pkt = self.telem.to_packet(dat)
-		ts = pkt.timestamp
+	# All the packets of this telemetry from one socket read
+	def handle_batch(self, dat):
+		arr = self.telem.to_array(dat)
 
-		if ts == 0:
-			self.time_data = []
-			for name in self.plot_data.keys():
-				self.plot_data[name] = []
+		# The pico restarted, only keep what came after
+		resets = np.flatnonzero(arr["timestamp"] == 0)
+		if len(resets) > 0:
+			arr = arr[resets[-1]:]
+			self.history.clear()
 
-		self.time_data.append(ts)
-		for name, val in pkt.vals().items():
-			self.plot_data[name].append(val)
+		self.history.extend(arr)
 
 plots = {}
-for idx, telem in robot.telems.items():
+for idx, telem in telems.items():
 	plots[idx] = TelemetryPlot(telem)
 
 def cb_func(idx, dat):
-	plots[idx].handle_data(dat)
-
-if len(sys.argv) < 2:
-	print("Give IP")
-	exit()
+	plots[idx].handle_batch(dat)
 
-cl = telemetry.Client(sys.argv[1], 1337, cb_func)
+cl = telemetry.Client(args.ip, args.port, batch_callback=cb_func)
 
 plt.show()
\ No newline at end of file
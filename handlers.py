@@ -1,5 +1,6 @@
 import RPi.GPIO as GPIO
 import threading, time
+import concurrent.futures
 import numpy as np
 import os
 try:
@@ -21,10 +22,16 @@ except Exception:
 	pass
 
 import metacom.mqtt as mqtt
+from comm.bus import Priority
+from comm.robot import MotionSegment
+import comm.trace
 
 # General constants
 MATCH_PLAY_TIME = 99
 INST_WAIT = 1
+# Oldest pose (in s) the sensors accept from the asserv pose cache,
+# above the refresh period (1/comm.robot.POSE_REFRESH_RATE) so the cache is hit between refreshes
+POSE_MAX_AGE = 0.03
 
 # Physical constants
 TABLE_WIDTH = 2000
@@ -205,9 +212,11 @@ class DisplayHandler:
 
 	def draw_display(self):
 		if self.debug:
+			snap = None
 			if self.asserv is not None:
-				dst, theta = self.asserv.get_pos()
-				x,y = self.asserv.get_pos_xy()
+				snap = self.asserv.get_snapshot(1/self.rate)
+				dst, theta = snap.pos
+				x,y = snap.pos_xy
 				theta %= (1 if theta >= 0 else -1)*2*np.pi
 
 				linest = f"{int(x)}"
@@ -223,7 +232,7 @@ class DisplayHandler:
 
 			if self.asserv is not None:
 				run = self.asserv.running
-				state = self.asserv.debug_get_controller_state()
+				state = snap.controller_state
 				if run:
 					if state == 0:
 						linest += "THETA"
@@ -261,8 +270,8 @@ class DisplayHandler:
 				self.disp.write_string(linest)
 
 			if self.asserv is not None:
-				lvel, lcurr, ltemp, lvbus = self.asserv.debug_get_left_bg_stats()
-				rvel, rcurr, rtemp, rvbus = self.asserv.debug_get_right_bg_stats()
+				lvel, lcurr, ltemp, lvbus = snap.left_bg_stats
+				rvel, rcurr, rtemp, rvbus = snap.right_bg_stats
 				linest = f"{int(ltemp)}C"
 				linest = linest.ljust(5)
 				linest += f"{lcurr:.1f}A"
@@ -386,13 +395,17 @@ class TOFHandler:
 def inst(func):
 	def inner(self, *args, **kwargs):
 		# Call the function normally
-		func(self, *args, **kwargs)
+		ret = func(self, *args, **kwargs)
 
 		blocking = kwargs["blocking"] if "blocking" in kwargs else True
+		# Futures return straight away, the wait is up to whoever joins them
+		blocking = blocking and not kwargs.get("future", False)
 
 		if self.inst_wait != 0 and blocking:
 			time.sleep(self.inst_wait)
 
+		return ret
+
 	return inner
 
 class BaseScenario:
@@ -404,6 +417,7 @@ class BaseScenario:
 		self.asserv = asserv
 		self.inst_wait = inst_wait
 		self.obs_restart = obs_restart
+		self.pose_max_age = POSE_MAX_AGE
 
 		self.start_info = mqtt.InfoDebut()
 		self.mcom = None
@@ -429,21 +443,44 @@ class BaseScenario:
 	# dst in mm, angle in deg
 	@inst
 	def move(self, dst, angle=0, **kwargs):
-		self.asserv.move(dst, np.radians(angle), **kwargs)
+		return self.asserv.move(dst, np.radians(angle), **kwargs)
 
 	# angle in deg
 	@inst
 	def turn(self, angle, **kwargs):
-		self.asserv.move(0, np.radians(angle), **kwargs)
+		return self.asserv.move(0, np.radians(angle), **kwargs)
 
 	# Table coords ? maybe
 	@inst
 	def move_abs(self, x, y, **kwargs):
-		self.asserv.move_abs(x, y, **kwargs)
+		return self.asserv.move_abs(x, y, **kwargs)
+
+	# Segments sent through the asserv queue so it doesn't stop in between, steps are (dst, angle) in mm/deg, ex:
+	# self.chain((300, 0), (0, 90), (200, 0))
+	@inst
+	def chain(self, *steps, **kwargs):
+		return self.asserv.enqueue([MotionSegment(dst, np.radians(angle)) for dst, angle in steps], **kwargs)
+
+	# Table coords, goes through the points without stopping at each one
+	@inst
+	def follow(self, points, **kwargs):
+		return self.asserv.follow_path(points, **kwargs)
+
+	# Waits for commands started with future=True, ex:
+	# self.join(self.move(200, future=True), self.arm_deploy(True, True, future=True))
+	def join(self, *futures):
+		concurrent.futures.wait(futures)
+		for fut in futures:
+			fut.result()
+
+		if self.inst_wait != 0:
+			time.sleep(self.inst_wait)
 
 	def get_rel_pos(self):
-		_, theta = self.asserv.get_pos()
-		x,y = self.asserv.get_pos_xy()
+		# Feeds obstacle detection, so it goes before display reads
+		snap = self.asserv.get_snapshot(self.pose_max_age, Priority.MOTION)
+		_, theta = snap.pos
+		x,y = snap.pos_xy
 		return x,y,theta
 
 	def get_pos(self, x_off=0, y_off=0):
@@ -501,11 +538,19 @@ class BaseScenario:
 	# Happens before the play, needs to wait for the right time here, either using a jumper or with mcom
 	def startup(self):
 		self.asserv.start()
+		self.asserv.start_pose_refresh()
 
 	# When you play returns, be called after 100s regardless
 	def finish(self):
 		print("Stopping everything")
 		self.asserv.stop()
+		self.asserv.stop_pose_refresh()
+		if comm.trace.TRACER is not None:
+			print(comm.trace.TRACER.summary(self.trace_names()))
+
+	# Register names of the picos used, for the I2C trace summary
+	def trace_names(self):
+		return self.asserv.register_names()
 
 class Scenario(BaseScenario):
 	def __init__(self, asserv, action, start_x, start_y, start_theta, inst_wait=0, jumper_safe=True, lidar_enable=True, lidar_restart=False, lidar_radius=300, lidar_margin=10, ip_nuc=None):
@@ -522,27 +567,27 @@ class Scenario(BaseScenario):
 		if left:
 			if deploy:
 				if half:
-					self.action.left_arm_half_deploy(**kwargs)
+					return self.action.left_arm_half_deploy(**kwargs)
 				else:
-					self.action.left_arm_deploy(**kwargs)
+					return self.action.left_arm_deploy(**kwargs)
 			else:
-				self.action.left_arm_fold(**kwargs)
+				return self.action.left_arm_fold(**kwargs)
 		else:
 			if deploy:
 				if half:
-					self.action.right_arm_half_deploy(**kwargs)
+					return self.action.right_arm_half_deploy(**kwargs)
 				else:
-					self.action.right_arm_deploy(**kwargs)
+					return self.action.right_arm_deploy(**kwargs)
 			else:
-				self.action.right_arm_fold(**kwargs)
+				return self.action.right_arm_fold(**kwargs)
 
 	# ammount in deg
 	@inst
 	def arm_turn(self, left, ammount, **kwargs):
 		if left:
-			self.action.left_arm_turn(ammount, **kwargs)
+			return self.action.left_arm_turn(ammount, **kwargs)
 		else:
-			self.action.right_arm_turn(ammount, **kwargs)
+			return self.action.right_arm_turn(ammount, **kwargs)
 
 	def set_score(self, score):
 		self.disp.set_score(score)
@@ -574,6 +619,11 @@ class Scenario(BaseScenario):
 		super().finish()
 		self.action.stop()
 
+	def trace_names(self):
+		names = super().trace_names()
+		names.update(self.action.register_names())
+		return names
+
 	def play(self):
 		raise NotImplementedError("Scenario needs a play method")
 